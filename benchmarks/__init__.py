@@ -0,0 +1,12 @@
+'''
+Benchmarks of tilebeard's serving modes, run against synthetic fixtures
+generated locally (rasters with world files, a GeoJSON file, a premade
+pyramid and a stand-in upstream tile server):
+
+    python -m benchmarks --output results.json
+
+Each scenario is driven with a number of concurrent clients and reports
+throughput, latency percentiles and memory per phase (eg. cold misses
+and warm hits), as JSON so that runs of different versions can be
+compared.
+'''
@@ -0,0 +1,112 @@
+import os
+import sys
+import time
+import json
+import asyncio
+import argparse
+import platform
+import tempfile
+
+import tilebeard
+from tilebeard.seed import parse_zoom
+
+from . import __doc__
+from .fixtures import make_fixtures
+from .runner import DISTRIBUTIONS
+from .scenarios import SCENARIOS, run_scenario
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        prog='python -m benchmarks', description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument('scenarios', nargs='*', metavar='scenario',
+        help='scenarios to run, of: {} (default: all)'.format(
+            ', '.join(SCENARIOS)
+        ))
+    parser.add_argument('--requests', type=int, default=2000,
+        help='requests per warm phase (default: 2000)')
+    parser.add_argument('--misses', type=int, default=200,
+        help='distinct tiles requested in cold phases (default: 200)')
+    parser.add_argument('--concurrency', type=int, default=16,
+        help='concurrent clients (default: 16)')
+    parser.add_argument('--zoom', type=parse_zoom, default=(0, 5),
+        help='zoom level or range of requested tiles (default: 0-5)')
+    parser.add_argument('--distribution', choices=DISTRIBUTIONS,
+        default='uniform',
+        help='uniform: zoom levels equally likely, tiles: each tile equally '
+        'likely (default: uniform)')
+    parser.add_argument('--seed', type=int, default=0,
+        help='random seed of the requested keys (default: 0)')
+    parser.add_argument('--metatile', type=int, default=1,
+        help='metatile size of generated tiles (default: 1)')
+    parser.add_argument('--processes', type=int, default=0,
+        help='render processes of generated tiles (default: 0, threads)')
+    parser.add_argument('--compresslevel', type=int, default=6,
+        help='gzip level of the compression scenario (default: 6)')
+    parser.add_argument('--width', type=int, default=2048,
+        help='width of the synthetic rasters in pixels (default: 2048)')
+    parser.add_argument('--features', type=int, default=20000,
+        help='features in the synthetic GeoJSON (default: 20000)')
+    parser.add_argument('--workdir', default=None,
+        help='directory for fixtures, kept and reused between runs '
+        '(default: a temporary directory)')
+    parser.add_argument('--output', default=None,
+        help='JSON results file (default: stdout)')
+    return parser
+
+def environment():
+    return {
+        'tilebeard': tilebeard.__version__,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+    }
+
+async def run(options):
+    paths = make_fixtures(
+        os.path.join(options.workdir, 'fixtures'), options.width,
+        options.features, options.zooms,
+    )
+    results = []
+    for name in options.scenarios:
+        sys.stderr.write('{}...\n'.format(name))
+        results.extend(await run_scenario(name, paths, options))
+    return results
+
+def main(argv=None):
+    parser = get_parser()
+    options = parser.parse_args(argv)
+    unknown = set(options.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error('unknown scenarios: {}'.format(', '.join(sorted(unknown))))
+    options.scenarios = options.scenarios or list(SCENARIOS)
+    options.zooms = range(options.zoom[0], options.zoom[1] + 1)
+    temporary = None
+    if options.workdir is None:
+        temporary = tempfile.TemporaryDirectory(prefix='tilebeard-bench-')
+        options.workdir = temporary.name
+    try:
+        results = asyncio.get_event_loop().run_until_complete(run(options))
+    finally:
+        if temporary is not None:
+            temporary.cleanup()
+    report = {
+        'environment': environment(),
+        'options': {
+            key: value for key, value in vars(options).items()
+            if key not in ('zooms', 'workdir', 'output')
+        },
+        'results': results,
+    }
+    output = json.dumps(report, indent=2)
+    if options.output is None:
+        sys.stdout.write(output + '\n')
+    else:
+        with open(options.output, 'w') as file:
+            file.write(output + '\n')
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,183 @@
+import io
+import os
+import random
+import numpy as np
+import ujson
+from PIL import Image
+from aiohttp import web
+
+from tilebeard.tilebeard import get_source, get_store
+from tilebeard.seed import seed, Progress
+
+WORLD = (-180.0, -90.0, 180.0, 90.0)
+MERCATOR = (-180.0, -85.0511287798, 180.0, 85.0511287798)
+
+def write_world_file(imagefile, size, bounds=WORLD):
+    w, s, e, n = bounds
+    worldfile = imagefile[:-2] + imagefile[-1] + 'w'
+    with open(worldfile, 'w') as file:
+        file.write('\n'.join(str(v) for v in (
+            (e - w) / size[0], 0, 0, -(n - s) / size[1], w, n,
+        )))
+
+def raster(path, width=2048, compressed=False):
+    '''
+    writes a synthetic RGB image covering the world, with smooth
+    gradients and some noise so tiles compress realistically
+    '''
+    height = width // 2
+    y, x = np.mgrid[0:height, 0:width]
+    rng = np.random.RandomState(0)
+    array = np.stack((
+        127 + 127 * np.sin(x / 97) * np.cos(y / 61),
+        255 * x / width,
+        255 * y / height,
+    ), axis=2) + rng.normal(0, 8, (height, width, 3))
+    image = Image.fromarray(np.clip(array, 0, 255).astype(np.uint8), 'RGB')
+    if compressed:
+        image.save(path, compression='tiff_adobe_deflate')
+    else:
+        image.save(path)
+    write_world_file(path, image.size)
+
+def polygon(rng, x, y, size):
+    points = 3 + rng.randrange(6)
+    angles = sorted(rng.uniform(0, 2 * np.pi) for __ in range(points))
+    ring = [
+        (x + size * np.cos(a), max(-85, min(85, y + size * np.sin(a))))
+        for a in angles
+    ]
+    return [ring + ring[:1]]
+
+def vectors(path, count=20000):
+    '''
+    writes a GeoJSON file of count random polygons, lines and points
+    with a few properties each
+    '''
+    rng = random.Random(0)
+    features = []
+    for i in range(count):
+        x, y = rng.uniform(-179, 179), rng.uniform(-84, 84)
+        kind = i % 3
+        if kind == 0:
+            geometry = {
+                'type': 'Polygon',
+                'coordinates': polygon(rng, x, y, rng.uniform(.05, 2)),
+            }
+        elif kind == 1:
+            geometry = {
+                'type': 'LineString',
+                'coordinates': [
+                    (x + j * .1, y + rng.uniform(-.1, .1)) for j in range(10)
+                ],
+            }
+        else:
+            geometry = {'type': 'Point', 'coordinates': (x, y)}
+        features.append({
+            'type': 'Feature',
+            'id': i,
+            'geometry': geometry,
+            'properties': {
+                'name': 'feature {}'.format(i),
+                'kind': ('polygon', 'line', 'point')[kind],
+                'value': rng.random(),
+            },
+        })
+    with open(path, 'w') as file:
+        file.write(ujson.dumps({
+            'type': 'FeatureCollection',
+            'features': features,
+        }))
+
+def pyramid(path, source, zooms, frmt='png'):
+    '''
+    renders a premade pyramid of source into path
+    '''
+    store = get_store(path, '/{}/{}/{}.' + frmt, frmt)
+    source = get_source(source, None, frmt, {})
+    seed(
+        source, store, MERCATOR, zooms, processes=0, metatile=8,
+        progress=Progress(0, stream=io.StringIO()),
+    )
+    source.close()
+    store.close()
+
+def make_fixtures(directory, width=2048, features=20000, zooms=range(6),
+    layers=3):
+    '''
+    generates the fixtures that are missing in directory, returning
+    their paths
+    '''
+    paths = {
+        'raw': os.path.join(directory, 'raw.tif'),
+        'compressed': os.path.join(directory, 'compressed.tif'),
+        'vectors': os.path.join(directory, 'vectors.geojson'),
+        'pyramid': os.path.join(
+            directory, 'pyramid-{}-{}'.format(width, max(zooms))
+        ),
+        'layers': os.path.join(directory, 'layer_{}.tif'),
+    }
+    os.makedirs(directory, exist_ok=True)
+    if not os.path.exists(paths['raw']):
+        raster(paths['raw'], width)
+    if not os.path.exists(paths['compressed']):
+        raster(paths['compressed'], width, compressed=True)
+    if not os.path.exists(paths['vectors']):
+        vectors(paths['vectors'], features)
+    if not os.path.exists(paths['pyramid']):
+        pyramid(paths['pyramid'] + '.tmp', paths['raw'], zooms)
+        os.rename(paths['pyramid'] + '.tmp', paths['pyramid'])
+    # ClusterBeard layers, all copies of the raw raster
+    for layer in range(layers):
+        image = paths['layers'].format(layer)
+        if not os.path.exists(image):
+            os.symlink(os.path.abspath(paths['raw']), image)
+            os.symlink(
+                os.path.abspath(paths['raw'][:-4] + '.tfw'),
+                image[:-4] + '.tfw',
+            )
+    return paths
+
+class TileServer:
+    '''
+    Stand-in upstream for proxy mode, serving a premade pyramid over
+    HTTP on localhost with caching headers.
+    '''
+
+    def __init__(self, path, max_age=3600):
+        self.path = path
+        self.max_age = max_age
+        self.runner = None
+        self.url = None
+        self.requests = 0
+
+    async def tile(self, request):
+        self.requests += 1
+        info = request.match_info
+        try:
+            with open(os.path.join(
+                self.path, info['z'], info['x'], info['y']
+            ), 'rb') as file:
+                content = file.read()
+        except FileNotFoundError:
+            return web.Response(status=404)
+        return web.Response(body=content, headers={
+            'Content-Type': 'image/png',
+            'Cache-Control': 'max-age={}'.format(self.max_age),
+        })
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get('/{z}/{x}/{y}', self.tile)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, '127.0.0.1', 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.url = 'http://127.0.0.1:{}'.format(port)
+        return self.url
+
+    async def close(self):
+        if self.runner is not None:
+            await self.runner.cleanup()
+            self.runner = None
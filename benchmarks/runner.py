@@ -0,0 +1,103 @@
+import os
+import time
+import random
+import asyncio
+import resource
+
+DISTRIBUTIONS = ('uniform', 'tiles')
+
+def pick_zoom(rng, zooms, distribution):
+    # uniform: every zoom level as likely, tiles: every tile as likely
+    if distribution == 'uniform':
+        return rng.choice(zooms)
+    return rng.choices(zooms, weights=[4**z for z in zooms])[0]
+
+def distinct_keys(count, zooms, distribution='uniform', seed=0, layers=()):
+    '''
+    returns up to count distinct (layer, z, x, y) keys, drawn with zoom
+    levels following distribution
+    '''
+    rng = random.Random(seed)
+    zooms = list(zooms)
+    available = sum(4**z for z in zooms) * max(len(layers), 1)
+    count = min(count, available)
+    keys = set()
+    while len(keys) < count:
+        z = pick_zoom(rng, zooms, distribution)
+        n = 2**z
+        layer = (rng.choice(layers),) if layers else ()
+        keys.add(layer + (z, rng.randrange(n), rng.randrange(n)))
+    keys = list(keys)
+    rng.shuffle(keys)
+    return keys
+
+def repeat_keys(keys, count, seed=0):
+    '''
+    count keys drawn at random from keys, for warm requests
+    '''
+    rng = random.Random(seed)
+    return [rng.choice(keys) for __ in range(count)]
+
+def rss():
+    '''
+    current resident set size in bytes, or the peak where that is all
+    the platform tells
+    '''
+    try:
+        with open('/proc/self/statm') as file:
+            return int(file.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return peak_rss()
+
+def peak_rss():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if os.uname().sysname == 'Darwin' else peak * 1024
+
+def percentile(values, q):
+    # values sorted, nearest rank
+    if not values:
+        return None
+    return values[min(len(values) - 1, max(0, round(q * len(values)) - 1))]
+
+async def drive(get, keys, concurrency=16):
+    '''
+    requests keys with concurrency clients, each sending its next
+    request as soon as the previous one is answered, and returns the
+    throughput, latencies, status counts and memory of the run
+    '''
+    latencies = []
+    status = {}
+    pending = iter(keys)
+
+    async def client():
+        for key in pending:
+            start = time.perf_counter()
+            response = await get(key)
+            latencies.append(time.perf_counter() - start)
+            status[response[0]] = status.get(response[0], 0) + 1
+
+    before = rss()
+    start = time.perf_counter()
+    await asyncio.gather(*(client() for __ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    after = rss()
+    latencies.sort()
+    ms = lambda seconds: None if seconds is None else round(seconds * 1000, 3)
+    return {
+        'requests': len(latencies),
+        'concurrency': concurrency,
+        'elapsed_s': round(elapsed, 4),
+        'throughput_rps': round(len(latencies) / elapsed, 1) if elapsed else None,
+        'latency_ms': {
+            'mean': ms(sum(latencies) / len(latencies)) if latencies else None,
+            'p50': ms(percentile(latencies, .5)),
+            'p99': ms(percentile(latencies, .99)),
+            'max': ms(latencies[-1] if latencies else None),
+        },
+        'status': {str(code): count for code, count in sorted(status.items())},
+        'memory_mb': {
+            'rss': round(after / 2**20, 1),
+            'rss_delta': round((after - before) / 2**20, 1),
+            'peak_rss': round(peak_rss() / 2**20, 1),
+        },
+    }
@@ -0,0 +1,195 @@
+import os
+import shutil
+import tempfile
+
+from tilebeard import TileBeard, ClusterBeard
+from tilebeard.filters import raster_ops, chain
+from tilebeard.tile import brotli
+
+from .fixtures import TileServer
+from .runner import drive, distinct_keys, repeat_keys
+
+CACHE_SIZE = 256 * 2**20
+
+class Run:
+    '''
+    One scenario's run: its keys, scratch directory for tile caches,
+    and the phase results, closing the TileBeards it made when done.
+    '''
+
+    def __init__(self, name, paths, options, layers=()):
+        self.name = name
+        self.paths = paths
+        self.options = options
+        self.results = []
+        self.beards = []
+        self.scratch = tempfile.mkdtemp(prefix=name + '-', dir=options.workdir)
+        self.keys = distinct_keys(
+            options.misses, options.zooms, options.distribution,
+            options.seed, layers,
+        )
+        self.warm = repeat_keys(self.keys, options.requests, options.seed)
+
+    def beard(self, cls=TileBeard, *args, **kwargs):
+        beard = cls(*args, **kwargs)
+        self.beards.append(beard)
+        return beard
+
+    def cache(self, name):
+        return os.path.join(self.scratch, name)
+
+    async def phase(self, phase, get, keys, **details):
+        result = dict(
+            scenario=self.name, phase=phase, details=details,
+            **await drive(get, keys, self.options.concurrency)
+        )
+        self.results.append(result)
+        return result
+
+    async def warmup(self, get):
+        for key in self.keys:
+            await get(key)
+
+    async def close(self):
+        for beard in self.beards:
+            await beard.close()
+        shutil.rmtree(self.scratch, ignore_errors=True)
+
+def getter(beard, headers={}, filter=None):
+    async def get(key):
+        return await beard(key, headers, filter)
+    return get
+
+async def premade(run):
+    path = run.paths['pyramid']
+    plain = run.beard(path=path)
+    await run.phase('disk_hit', getter(plain), run.warm)
+    indexed = run.beard(path=path, tile_index=True)
+    await run.warmup(getter(indexed))
+    await run.phase('indexed_hit', getter(indexed), run.warm)
+    cached = run.beard(path=path, cache_size=CACHE_SIZE)
+    await run.warmup(getter(cached))
+    await run.phase('memory_hit', getter(cached), run.warm)
+    etags = {}
+    for key in run.keys:
+        etags[key] = {'If-None-Match': (await cached(key))[1].get('ETag')}
+    async def conditional(key):
+        return await cached(key, etags[key])
+    await run.phase('not_modified', conditional, run.warm)
+
+async def compression(run):
+    # variants are written next to the tiles, so into a copy
+    path = run.cache('pyramid')
+    shutil.copytree(run.paths['pyramid'], path)
+    encodings = [('gzip', {'compresslevel': run.options.compresslevel})]
+    if brotli is not None:
+        encodings.append(('br', {'brotli': 5}))
+    for encoding, kwargs in encodings:
+        headers = {'Accept-Encoding': encoding}
+        beard = run.beard(path=path, **kwargs)
+        await run.phase(
+            encoding + '_miss', getter(beard, headers), run.keys, **kwargs
+        )
+        await run.phase(
+            encoding + '_hit', getter(beard, headers), run.warm, **kwargs
+        )
+        cached = run.beard(path=path, cache_size=CACHE_SIZE, **kwargs)
+        await run.warmup(getter(cached, headers))
+        await run.phase(
+            encoding + '_memory_hit', getter(cached, headers), run.warm,
+            **kwargs
+        )
+
+async def generated(run, source, **kwargs):
+    options = run.options
+    kwargs.update(metatile=options.metatile, processes=options.processes)
+    path = run.cache('tiles')
+    beard = run.beard(source=source, path=path, **kwargs)
+    await run.phase('miss', getter(beard), run.keys, **kwargs)
+    await run.phase('hit', getter(beard), run.warm, **kwargs)
+    cached = run.beard(
+        source=source, path=path, cache_size=CACHE_SIZE, **kwargs
+    )
+    await run.warmup(getter(cached))
+    await run.phase('memory_hit', getter(cached), run.warm, **kwargs)
+
+async def raster_raw(run):
+    await generated(run, run.paths['raw'])
+
+async def raster_compressed(run):
+    await generated(run, run.paths['compressed'])
+
+async def vector_geojson(run):
+    await generated(run, run.paths['vectors'], frmt='geojson', index=True)
+
+async def vector_mvt(run):
+    await generated(run, run.paths['vectors'], frmt='mvt', index=True)
+
+async def proxy(run):
+    server = TileServer(run.paths['pyramid'])
+    url = await server.start()
+    try:
+        passthrough = run.beard(url=url)
+        cached = run.beard(url=url, path=run.cache('tiles'))
+        for phase, beard, keys in (
+            ('passthrough', passthrough, run.keys),
+            ('miss', cached, run.keys),
+            ('hit', cached, run.warm),
+        ):
+            before = server.requests
+            result = await run.phase(phase, getter(beard), keys)
+            result['details']['upstream_requests'] = server.requests - before
+    finally:
+        for beard in run.beards:
+            await beard.close()
+        run.beards = []
+        await server.close()
+
+async def filters(run):
+    path = run.paths['pyramid']
+    pipelines = [
+        ('grayscale', raster_ops.grayscale),
+        ('chain', chain(
+            raster_ops.invert, raster_ops.posterize(bits=4), raster_ops.mirror
+        )),
+    ]
+    plain = run.beard(path=path)
+    cached = run.beard(path=path, cache_size=CACHE_SIZE)
+    for name, pipeline in pipelines:
+        await run.phase(name, getter(plain, filter=pipeline), run.warm)
+        await run.warmup(getter(cached, filter=pipeline))
+        await run.phase(
+            name + '_memory_hit', getter(cached, filter=pipeline), run.warm
+        )
+
+async def cluster(run):
+    options = run.options
+    beard = run.beard(
+        ClusterBeard, run.paths['layers'],
+        tilepath=run.cache('tiles'), metatile=options.metatile,
+        processes=options.processes,
+    )
+    await run.phase('miss', getter(beard), run.keys)
+    await run.phase('hit', getter(beard), run.warm)
+
+# name: (scenario, layer arguments of its keys)
+SCENARIOS = {
+    'premade': (premade, ()),
+    'compression': (compression, ()),
+    'raster_raw': (raster_raw, ()),
+    'raster_compressed': (raster_compressed, ()),
+    'vector_geojson': (vector_geojson, ()),
+    'vector_mvt': (vector_mvt, ()),
+    'proxy': (proxy, ()),
+    'filters': (filters, ()),
+    'cluster': (cluster, ('0', '1', '2')),
+}
+
+async def run_scenario(name, paths, options):
+    scenario, layers = SCENARIOS[name]
+    run = Run(name, paths, options, layers)
+    try:
+        await scenario(run)
+    finally:
+        await run.close()
+    return run.results
@@ -0,0 +1,19 @@
+import sys
+import argparse
+
+from . import seed
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m tilebeard')
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+    seed.add_arguments(commands.add_parser(
+        'seed', help='pre-render tiles of an on-demand layer',
+        description=seed.__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    ))
+    args = parser.parse_args(argv)
+    return seed.main(args)
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,168 @@
+import os
+import threading
+
+from .tbutils import LRUCache
+from .tile import FileStore, VARIANTS, _replacefile
+
+LOG = '.access.log'
+
+class DiskCache(FileStore):
+    '''
+    FileStore for cached tiles, bounded to maxsize bytes on disk. The
+    least recently used tiles (with their variants and metadata) are
+    deleted to make room for new ones. Sizes and recency are kept in
+    memory and in an access log under path, which is replayed on start
+    instead of walking the directory, and compacted as it grows. A
+    cache directory without a log is scanned once to adopt its tiles.
+    '''
+
+    def __init__(self, path, template, mode, maxsize, compact=10000):
+        super(DiskCache, self).__init__(path, template, mode)
+        self.maxsize = maxsize
+        self.compact_after = compact
+        # unbounded until loaded, so replaying never drops a tile's entry
+        self.index = LRUCache(float('inf'), sizeof=lambda size: size)
+        self.lock = threading.RLock()
+        self.logfile = os.path.join(path, LOG)
+        self.log = None
+        self.logged = 0
+        self.load()
+
+    def relative(self, address):
+        return os.path.relpath(address, self.path)
+
+    def load(self):
+        os.makedirs(self.path, exist_ok=True)
+        if os.path.exists(self.logfile):
+            with open(self.logfile, 'r') as log:
+                for line in log:
+                    op, __, rest = line.rstrip('\n').partition(' ')
+                    if op == 'r':
+                        self.index.get(rest)
+                        continue
+                    size, __, name = rest.partition(' ')
+                    if op == 'w':
+                        self.index.put(name, int(size))
+                    elif op == 'd':
+                        self.index.pop(name)
+        else:
+            for key, mtime, size in sorted(self.scan(), key=lambda t: t[1]):
+                self.index.put(self.relative(self.address(key)), size)
+        for name, size in self.index.items(): # the budget may have shrunk
+            if self.index.size <= self.maxsize:
+                break
+            self.index.pop(name)
+            self.remove(name)
+        self.index.maxsize = self.maxsize
+        self.index.on_evict = self.evict
+        self.compact()
+
+    def compact(self):
+        '''
+        rewrites the access log with one line per tile, oldest first
+        '''
+        with self.lock:
+            if self.log is not None:
+                self.log.close()
+            _replacefile(self.logfile, ''.join(
+                'w {} {}\n'.format(size, name)
+                for name, size in self.index.items()
+            ), '')
+            self.log = open(self.logfile, 'a')
+            self.logged = 0
+
+    def append(self, line, flush=False):
+        with self.lock:
+            if self.log is None:
+                return
+            self.log.write(line)
+            self.logged += 1
+            if self.logged > max(self.compact_after, 4 * len(self.index)):
+                self.compact()
+            elif flush:
+                self.log.flush()
+
+    def remove(self, name):
+        address = os.path.join(self.path, name)
+        for path in (address, address + '.meta', *(
+            address + suffix for suffix in VARIANTS.values()
+        )):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def evict(self, name, size):
+        self.remove(name)
+        self.append('d 0 {}\n'.format(name), flush=True)
+
+    def account(self, address, size, add=False):
+        '''
+        records the size of the tile at address, or with add, adds size to
+        it; returns False, leaving the entry as it was, if the tile is gone
+        or would no longer fit in the cache
+        '''
+        name = self.relative(address)
+        with self.lock:
+            if add:
+                kept = self.index.pop(name)
+                if kept is None:
+                    return False
+                if kept + size > self.maxsize:
+                    self.index.put(name, kept)
+                    return False
+                size += kept
+            self.index.put(name, size)
+            self.append('w {} {}\n'.format(size, name), flush=True)
+            return True
+
+    def touch(self, name):
+        if self.index.get(name) is None:
+            return False
+        self.append('r {}\n'.format(name))
+        return True
+
+    def read(self, address):
+        content = super(DiskCache, self).read(address)
+        if not self.touch(self.relative(address)):
+            # left by an earlier run that did not get to log it
+            self.account(address, len(content))
+        return content
+
+    def read_variant(self, address, encoding):
+        content = super(DiskCache, self).read_variant(address, encoding)
+        self.touch(self.relative(address))
+        return content
+
+    def write(self, address, content):
+        if len(content) > self.maxsize:
+            return # would evict everything and itself
+        super(DiskCache, self).write(address, content)
+        self.account(address, len(content))
+
+    def write_variant(self, address, encoding, content):
+        if self.relative(address) not in self.index:
+            return # the tile itself was not kept
+        super(DiskCache, self).write_variant(address, encoding, content)
+        if not self.account(address, len(content), add=True):
+            try:
+                os.remove(address + VARIANTS[encoding])
+            except FileNotFoundError:
+                pass
+
+    def write_meta(self, address, meta):
+        if self.relative(address) not in self.index:
+            return
+        super(DiskCache, self).write_meta(address, meta)
+
+    def stats(self):
+        '''
+        tile count, size in bytes and eviction counters of the cache
+        '''
+        return self.index.stats()
+
+    def close(self):
+        with self.lock:
+            if self.log is not None:
+                self.log.close()
+                self.log = None
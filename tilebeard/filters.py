@@ -1,29 +1,209 @@
-from PIL import ImageOps
-
-from .tbutils import apply2bytes, constructable_filter, ObjDict
-
-# wrapper around some of PIL's ImageOps methods
-raster_ops = {
-    imgop: apply2bytes(
-        ImageOps.__dict__[imgop]
-    ) for imgop in (
-        'invert',
-        'grayscale',
-        'flip',
-        'mirror',
-    )
+from io import BytesIO
+from PIL import Image, ImageColor
+import numpy as np
+
+from .tbutils import ObjDict
+
+IDENTITY = np.arange(256, dtype=np.uint8)
+
+MODES = {
+    1: 'L',
+    2: 'LA',
+    3: 'RGB',
+    4: 'RGBA',
 }
 
-raster_ops.update({
-    imgop: constructable_filter(
-        ImageOps.__dict__[imgop]
-    ) for imgop in (
-        'autocontrast',
-        'colorize',
-        'equalize',
-        'posterize',
-        'solarize',
+class Op:
+    '''
+    Single array operation of a filter pipeline. func takes and returns
+    an (height, width, bands) uint8 array of the color bands; geometric
+    ops are applied to the alpha band too. Ops that only remap values
+    can give a 256 entry lookup table instead, so that consecutive ones
+    are fused into a single lookup. The signature names the op and its
+    arguments, and is what filtered tiles are cached by.
+    '''
+
+    def __init__(self, signature, func=None, lut=None, geometric=False):
+        self.signature = signature
+        self.func = func
+        self.lut = lut
+        self.geometric = geometric
+
+def run(ops, color, alpha):
+    lut = None
+    for op in ops:
+        if op.lut is not None:
+            lut = op.lut if lut is None else op.lut[lut]
+            continue
+        if lut is not None:
+            color, lut = lut[color], None
+        color = op.func(color)
+        if op.geometric and alpha is not None:
+            alpha = op.func(alpha)
+    if lut is not None:
+        color = lut[color]
+    return color, alpha
+
+def decode(content):
+    image = Image.open(BytesIO(content))
+    frmt = image.format or 'PNG'
+    if image.mode not in ('L', 'LA', 'RGB', 'RGBA'):
+        transparent = 'A' in image.mode or 'transparency' in image.info
+        image = image.convert('RGBA' if transparent else 'RGB')
+    array = np.asarray(image)
+    if array.ndim == 2:
+        array = array[:, :, None]
+    if image.mode in ('LA', 'RGBA'):
+        return array[:, :, :-1], array[:, :, -1:], frmt
+    return array, None, frmt
+
+def encode(color, alpha, frmt):
+    if alpha is not None:
+        color = np.concatenate((color, alpha), axis=2)
+    bands = color.shape[2]
+    image = Image.fromarray(
+        np.ascontiguousarray(color if bands > 1 else color[:, :, 0]),
+        MODES[bands]
     )
-})
+    output = BytesIO()
+    image.save(output, format=frmt)
+    return output.getvalue()
+
+class Pipeline:
+    '''
+    Filter made of any number of ops (or other pipelines), applied to a
+    tile in one pass: the tile is decoded into an array once, run through
+    all the ops and encoded once, in its original format.
+    '''
+
+    def __init__(self, *ops):
+        self.ops = []
+        for op in ops:
+            self.ops.extend(op.ops if isinstance(op, Pipeline) else (op,))
+        self.signature = tuple(op.signature for op in self.ops)
+
+    def __or__(self, other):
+        return Pipeline(self, other)
+
+    def __call__(self, content):
+        color, alpha, frmt = decode(content)
+        color, alpha = run(self.ops, color, alpha)
+        return encode(color, alpha, frmt)
+
+def chain(*filters):
+    return Pipeline(*filters)
+
+def lut_filter(name, make_lut):
+    def constructor(*args, **kwargs):
+        return Pipeline(Op(
+            (name, repr(args), repr(sorted(kwargs.items()))),
+            lut=make_lut(*args, **kwargs),
+        ))
+    return constructor
 
-raster_ops = ObjDict(raster_ops)
+def array_filter(name, make_func, geometric=False):
+    def constructor(*args, **kwargs):
+        return Pipeline(Op(
+            (name, repr(args), repr(sorted(kwargs.items()))),
+            func=make_func(*args, **kwargs),
+            geometric=geometric,
+        ))
+    return constructor
+
+def luminance(color):
+    # same weights as PIL's conversion to L
+    if color.shape[2] < 3:
+        return color[:, :, :1]
+    gray = color[:, :, :3].astype(np.uint32) @ np.array(
+        (19595, 38470, 7471), dtype=np.uint32
+    )
+    return ((gray + 0x8000) >> 16).astype(np.uint8)[:, :, None]
+
+def band_luts(color, make_lut):
+    # per band lookup tables computed from each band's histogram
+    out = np.empty_like(color)
+    for b in range(color.shape[2]):
+        band = color[:, :, b]
+        out[:, :, b] = make_lut(np.bincount(band.ravel(), minlength=256))[band]
+    return out
+
+def invert_lut():
+    return 255 - IDENTITY
+
+def posterize_lut(bits):
+    return IDENTITY & np.uint8(~(2**(8 - bits) - 1) & 0xff)
+
+def solarize_lut(threshold=128):
+    return np.where(IDENTITY < threshold, IDENTITY, 255 - IDENTITY).astype(np.uint8)
+
+def grayscale():
+    return luminance
+
+def flip():
+    return lambda array: array[::-1]
+
+def mirror():
+    return lambda array: array[:, ::-1]
+
+def autocontrast(cutoff=0, ignore=None):
+    if isinstance(cutoff, (int, float)):
+        cutoff = (cutoff, cutoff)
+    if isinstance(ignore, int):
+        ignore = (ignore,)
+    def make_lut(histogram):
+        if ignore is not None:
+            histogram = histogram.copy()
+            histogram[list(ignore)] = 0
+        total = histogram.sum()
+        low = np.searchsorted(np.cumsum(histogram), total * cutoff[0] // 100, 'right')
+        high = 255 - np.searchsorted(
+            np.cumsum(histogram[::-1]), total * cutoff[1] // 100, 'right'
+        )
+        if high <= low:
+            return IDENTITY
+        scale = 255 / (high - low)
+        return np.clip(
+            (IDENTITY * scale - low * scale).astype(np.int64), 0, 255
+        ).astype(np.uint8)
+    return lambda color: band_luts(color, make_lut)
+
+def equalize():
+    def make_lut(histogram):
+        used = histogram[histogram > 0]
+        if len(used) <= 1:
+            return IDENTITY
+        step = (used.sum() - used[-1]) // 255
+        if not step:
+            return IDENTITY
+        n = step // 2 + np.concatenate(((0,), np.cumsum(histogram)[:-1]))
+        return np.minimum(n // step, 255).astype(np.uint8)
+    return lambda color: band_luts(color, make_lut)
+
+def colorize(black, white, mid=None, blackpoint=0, whitepoint=255,
+    midpoint=127):
+    '''
+    maps the luminance of the tile onto a black - (mid) - white gradient
+    '''
+    points = [(blackpoint, black), (whitepoint, white)]
+    if mid is not None:
+        points.insert(1, (midpoint, mid))
+    xs = [point for point, color in points]
+    colors = np.array([ImageColor.getrgb(color)[:3] for x, color in points])
+    lut = np.stack([
+        np.round(np.interp(IDENTITY, xs, colors[:, band])) for band in range(3)
+    ], axis=1).astype(np.uint8)
+    return lambda color: lut[luminance(color)[:, :, 0]]
+
+# filters for PIL ImageOps methods of the same names, applied to arrays
+raster_ops = ObjDict({
+    'invert': lut_filter('invert', invert_lut)(),
+    'grayscale': array_filter('grayscale', grayscale)(),
+    'flip': array_filter('flip', flip, geometric=True)(),
+    'mirror': array_filter('mirror', mirror, geometric=True)(),
+    # these take arguments, eg. raster_ops.posterize(bits=4)
+    'autocontrast': array_filter('autocontrast', autocontrast),
+    'colorize': array_filter('colorize', colorize),
+    'equalize': array_filter('equalize', equalize),
+    'posterize': lut_filter('posterize', posterize_lut),
+    'solarize': lut_filter('solarize', solarize_lut),
+})
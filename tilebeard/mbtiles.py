@@ -0,0 +1,346 @@
+import os
+import time
+import queue
+import sqlite3
+import threading
+from urllib.request import pathname2url
+import ujson
+
+from .tbutils import get_digest
+
+SCHEMA = (
+    'CREATE TABLE IF NOT EXISTS metadata (name TEXT, value TEXT)',
+    'CREATE TABLE IF NOT EXISTS tiles (zoom_level INTEGER, '
+    'tile_column INTEGER, tile_row INTEGER, tile_data BLOB)',
+    'CREATE UNIQUE INDEX IF NOT EXISTS tile_index '
+    'ON tiles (zoom_level, tile_column, tile_row)',
+    'CREATE TABLE IF NOT EXISTS tile_meta (zoom_level INTEGER, '
+    'tile_column INTEGER, tile_row INTEGER, meta TEXT, '
+    'PRIMARY KEY (zoom_level, tile_column, tile_row))',
+)
+
+# deduplicated layout: each distinct tile stored once in images
+DEDUPE_SCHEMA = (
+    'CREATE TABLE IF NOT EXISTS metadata (name TEXT, value TEXT)',
+    'CREATE TABLE IF NOT EXISTS map (zoom_level INTEGER, '
+    'tile_column INTEGER, tile_row INTEGER, tile_id TEXT)',
+    'CREATE UNIQUE INDEX IF NOT EXISTS map_index '
+    'ON map (zoom_level, tile_column, tile_row)',
+    'CREATE TABLE IF NOT EXISTS images (tile_id TEXT PRIMARY KEY, '
+    'tile_data BLOB)',
+    'CREATE VIEW IF NOT EXISTS tiles AS SELECT map.zoom_level AS zoom_level, '
+    'map.tile_column AS tile_column, map.tile_row AS tile_row, '
+    'images.tile_data AS tile_data FROM map '
+    'JOIN images ON images.tile_id = map.tile_id',
+    SCHEMA[-1],
+)
+
+SELECT_METADATA = 'SELECT name, value FROM metadata'
+
+DELETE_METADATA = 'DELETE FROM metadata WHERE name = ?'
+
+INSERT_METADATA = 'INSERT INTO metadata (name, value) VALUES (?, ?)'
+
+SELECT_TILE = (
+    'SELECT tile_data FROM tiles '
+    'WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?'
+)
+
+SELECT_TILE_ID = (
+    'SELECT tile_id FROM map '
+    'WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?'
+)
+
+INSERT_IMAGE = (
+    'INSERT OR IGNORE INTO images (tile_id, tile_data) VALUES (?, ?)'
+)
+
+INSERT_MAP = (
+    'INSERT OR REPLACE INTO map '
+    '(zoom_level, tile_column, tile_row, tile_id) VALUES (?, ?, ?, ?)'
+)
+
+HAS_MAP = "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'map'"
+
+EXISTS_TILE = (
+    'SELECT 1 FROM tiles '
+    'WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?'
+)
+
+SCAN_TILES = (
+    'SELECT zoom_level, tile_column, tile_row, length(tile_data) FROM tiles'
+)
+
+SELECT_META = (
+    'SELECT meta FROM tile_meta '
+    'WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?'
+)
+
+INSERT_META = (
+    'INSERT OR REPLACE INTO tile_meta '
+    '(zoom_level, tile_column, tile_row, meta) VALUES (?, ?, ?, ?)'
+)
+
+INSERT_TILE = (
+    'INSERT OR REPLACE INTO tiles '
+    '(zoom_level, tile_column, tile_row, tile_data) VALUES (?, ?, ?, ?)'
+)
+
+def flip_y(z, y):
+    # MBTiles rows follow the TMS scheme, counted from the bottom
+    return (1 << z) - 1 - y
+
+class MBTiles:
+    '''
+    Tile store backed by an MBTiles (SQLite) file, addressed by (z, x, y).
+    Reads go through a pool of read-only connections, each of which keeps
+    its prepared statements cached. Writes are buffered and committed in
+    batches by a single writer connection; buffered tiles are readable
+    before they are committed. Upstream cache metadata of proxied tiles
+    is kept in an extra tile_meta table.
+    With dedupe=True, new files use the map/images layout, storing each
+    distinct tile once under its hash, which is also its ETag. Existing
+    files in that layout are detected and written the same way.
+    New files get the metadata rows the spec requires: name (the file
+    name, unless given) and format, along with any others in metadata.
+    '''
+
+    def __init__(self, file, readers=4, batch=256, flush_interval=5,
+        dedupe=False, metadata=None):
+        self.file = file
+        self.batch = batch
+        self.flush_interval = flush_interval
+        self.pending = {}
+        self.pending_meta = {}
+        self.pending_since = None
+        self.lock = threading.Lock()
+        self.readers = queue.LifoQueue()
+        self.maxreaders = readers
+        self.nreaders = 0
+        self.writer = None
+        if not os.path.exists(file):
+            self.dedupe = dedupe
+            self.get_writer()
+            self.set_metadata(dict({
+                'name': os.path.splitext(os.path.basename(file))[0],
+                'format': 'png',
+            }, **(metadata or {})))
+        else:
+            reader = self.get_reader()
+            try:
+                self.dedupe = reader.execute(HAS_MAP).fetchone() is not None
+            finally:
+                self.readers.put(reader)
+
+    def address(self, key):
+        return tuple(int(k) for k in key[-3:])
+
+    def get_writer(self):
+        if self.writer is None:
+            writer = sqlite3.connect(self.file, check_same_thread=False)
+            writer.execute('PRAGMA journal_mode=WAL')
+            for statement in DEDUPE_SCHEMA if self.dedupe else SCHEMA:
+                writer.execute(statement)
+            writer.commit()
+            self.writer = writer
+        return self.writer
+
+    def get_reader(self):
+        try:
+            return self.readers.get_nowait()
+        except queue.Empty:
+            pass
+        with self.lock:
+            create = self.nreaders < self.maxreaders
+            if create:
+                self.nreaders += 1
+        if not create:
+            return self.readers.get()
+        return sqlite3.connect(
+            'file:{}?mode=ro'.format(pathname2url(os.path.abspath(self.file))),
+            uri=True,
+            check_same_thread=False,
+        )
+
+    def read(self, address):
+        try:
+            return self.pending[address]
+        except KeyError:
+            pass
+        z, x, y = address
+        reader = self.get_reader()
+        try:
+            row = reader.execute(SELECT_TILE, (z, x, flip_y(z, y))).fetchone()
+        finally:
+            self.readers.put(reader)
+        if row is None:
+            raise FileNotFoundError(address)
+        return bytes(row[0])
+
+    def exists(self, address):
+        if address in self.pending:
+            return True
+        z, x, y = address
+        reader = self.get_reader()
+        try:
+            row = reader.execute(EXISTS_TILE, (z, x, flip_y(z, y))).fetchone()
+        finally:
+            self.readers.put(reader)
+        return row is not None
+
+    def scan(self):
+        '''
+        yields (key, mtime, size) of every tile, mtime being the file's
+        '''
+        self.flush()
+        mtime = self.modified()
+        reader = self.get_reader()
+        try:
+            rows = reader.execute(SCAN_TILES).fetchall()
+        finally:
+            self.readers.put(reader)
+        for z, x, y, size in rows:
+            yield (z, x, flip_y(z, y)), mtime, size
+
+    def read_meta(self, address):
+        try:
+            return self.pending_meta[address]
+        except KeyError:
+            pass
+        z, x, y = address
+        reader = self.get_reader()
+        try:
+            row = reader.execute(SELECT_META, (z, x, flip_y(z, y))).fetchone()
+        except sqlite3.OperationalError: # file created elsewhere, no table
+            row = None
+        finally:
+            self.readers.put(reader)
+        if row is None:
+            return None
+        return ujson.loads(row[0])
+
+    def write_meta(self, address, meta):
+        with self.lock:
+            self.pending_meta[address] = meta
+        self.write(address, None)
+
+    def write(self, address, content):
+        if isinstance(content, str):
+            content = content.encode()
+        with self.lock:
+            if content is not None:
+                self.pending[address] = content
+            if self.pending_since is None:
+                self.pending_since = time.monotonic()
+            due = (
+                len(self.pending) + len(self.pending_meta) >= self.batch or
+                time.monotonic() - self.pending_since >= self.flush_interval
+            )
+        if due:
+            self.flush()
+
+    def write_many(self, tiles):
+        '''
+        writes a batch of {address: content} and commits it at once
+        '''
+        with self.lock:
+            for address, content in tiles.items():
+                if isinstance(content, str):
+                    content = content.encode()
+                self.pending[address] = content
+            if self.pending_since is None:
+                self.pending_since = time.monotonic()
+        self.flush()
+
+    def flush(self):
+        with self.lock:
+            tiles = dict(self.pending)
+            metas = dict(self.pending_meta)
+            self.pending_since = None
+            if not tiles and not metas:
+                return
+            writer = self.get_writer()
+            if self.dedupe:
+                digests = {
+                    address: get_digest(content)
+                    for address, content in tiles.items()
+                }
+                writer.executemany(INSERT_IMAGE, (
+                    (digests[address], content)
+                    for address, content in tiles.items()
+                ))
+                writer.executemany(INSERT_MAP, (
+                    (z, x, flip_y(z, y), digests[(z, x, y)])
+                    for z, x, y in tiles
+                ))
+            else:
+                writer.executemany(INSERT_TILE, (
+                    (z, x, flip_y(z, y), content)
+                    for (z, x, y), content in tiles.items()
+                ))
+            writer.executemany(INSERT_META, (
+                (z, x, flip_y(z, y), ujson.dumps(meta))
+                for (z, x, y), meta in metas.items()
+            ))
+            writer.commit()
+            for pending, written in ((self.pending, tiles), (self.pending_meta, metas)):
+                for address, value in written.items():
+                    if pending.get(address) is value:
+                        del pending[address]
+
+    def get_metadata(self):
+        reader = self.get_reader()
+        try:
+            return dict(reader.execute(SELECT_METADATA).fetchall())
+        finally:
+            self.readers.put(reader)
+
+    def set_metadata(self, metadata):
+        '''
+        writes metadata rows, replacing those of the same names
+        '''
+        with self.lock:
+            writer = self.get_writer()
+            writer.executemany(DELETE_METADATA, ((name,) for name in metadata))
+            writer.executemany(INSERT_METADATA, (
+                (name, str(value)) for name, value in metadata.items()
+            ))
+            writer.commit()
+
+    def modified(self, address=None):
+        return os.path.getmtime(self.file)
+
+    def digest(self, address):
+        '''
+        hash of a deduplicated tile, None if it is not one
+        '''
+        if not self.dedupe:
+            return None
+        with self.lock:
+            content = self.pending.get(address)
+        if content is not None: # not flushed yet
+            return get_digest(content)
+        z, x, y = address
+        reader = self.get_reader()
+        try:
+            row = reader.execute(SELECT_TILE_ID, (z, x, flip_y(z, y))).fetchone()
+        finally:
+            self.readers.put(reader)
+        return None if row is None else row[0]
+
+    def etag(self, timestamp, address):
+        digest = self.digest(address)
+        if digest is not None:
+            return digest
+        return ''.join(str(a) for a in (timestamp, *address))
+
+    def close(self):
+        self.flush()
+        while True:
+            try:
+                self.readers.get_nowait().close()
+            except queue.Empty:
+                break
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
@@ -0,0 +1,277 @@
+'''
+Encoder for Mapbox Vector Tiles (version 2 of the spec), written out by
+hand so no protobuf dependency is needed, and for GeoJSON with the same
+integer tile coordinates.
+'''
+
+import math
+import struct
+import numpy as np
+import ujson
+
+POINT = 1
+LINESTRING = 2
+POLYGON = 3
+
+MOVE_TO = 1
+LINE_TO = 2
+CLOSE_PATH = 7
+
+EARTH_RADIUS = 6378137.0
+MAXLAT = 85.0511287798
+
+def varint(value):
+    out = bytearray()
+    while value > 0x7f:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+def zigzag(value):
+    return (value << 1) ^ (value >> 63)
+
+def field(number, wiretype):
+    return varint(number << 3 | wiretype)
+
+def message(number, data):
+    return field(number, 2) + varint(len(data)) + data
+
+def packed(number, values):
+    return message(number, b''.join(varint(v) for v in values))
+
+def project(coords):
+    '''
+    lon/lat degrees to web mercator meters
+    '''
+    lon = np.radians(coords[:, 0])
+    lat = np.radians(np.clip(coords[:, 1], -MAXLAT, MAXLAT))
+    return np.column_stack((
+        EARTH_RADIUS * lon,
+        EARTH_RADIUS * np.log(np.tan(math.pi / 4 + lat / 2)),
+    ))
+
+class Grid:
+    '''
+    Maps source coordinates to the integer grid of a tile covering box,
+    with the origin in the top left corner.
+    '''
+
+    def __init__(self, box, srid='4326', extent=4096):
+        self.srid = srid
+        self.extent = extent
+        corners = np.array(((box[0], box[1]), (box[2], box[3])), dtype=float)
+        if srid == '4326':
+            corners = project(corners)
+        (self.left, self.bottom), (right, top) = corners
+        self.top = top
+        self.xscale = extent / (right - self.left)
+        self.yscale = extent / (top - self.bottom)
+
+    def __call__(self, coords):
+        coords = np.asarray(coords, dtype=float)[:, :2]
+        if self.srid == '4326':
+            coords = project(coords)
+        grid = np.empty(coords.shape, dtype=np.int64)
+        grid[:, 0] = np.round((coords[:, 0] - self.left) * self.xscale)
+        grid[:, 1] = np.round((self.top - coords[:, 1]) * self.yscale)
+        return grid
+
+def dedupe(coords):
+    # repeated points are left over where vertices snapped to one cell
+    if len(coords) < 2:
+        return coords
+    keep = np.ones(len(coords), dtype=bool)
+    keep[1:] = np.any(coords[1:] != coords[:-1], axis=1)
+    return coords[keep]
+
+def area(ring):
+    x, y = ring[:, 0], ring[:, 1]
+    return int(np.sum(x * np.roll(y, -1) - np.roll(x, -1) * y))
+
+def flatten(geom):
+    '''
+    returns the type and parts of the highest dimension members of geom,
+    as points, lines or polygons (lists of rings)
+    '''
+    points, lines, polygons = [], [], []
+    stack = [geom]
+    while stack:
+        geom = stack.pop()
+        kind = geom.geom_type
+        if geom.is_empty:
+            continue
+        elif kind == 'Point':
+            points.append(geom.coords)
+        elif kind in ('LineString', 'LinearRing'):
+            lines.append(geom.coords)
+        elif kind == 'Polygon':
+            polygons.append(
+                [geom.exterior.coords] + [ring.coords for ring in geom.interiors]
+            )
+        else:
+            stack.extend(reversed(geom.geoms))
+    if polygons:
+        return POLYGON, polygons
+    if lines:
+        return LINESTRING, lines
+    return POINT, points
+
+def quantize(geom, grid):
+    '''
+    returns the type and parts of geom on grid, with degenerate parts
+    dropped and polygon rings wound as the spec wants (exterior rings
+    clockwise on screen), or None if nothing is left
+    '''
+    kind, parts = flatten(geom)
+    if kind == POINT:
+        parts = [grid(part) for part in parts]
+    elif kind == LINESTRING:
+        parts = [
+            line for line in (dedupe(grid(part)) for part in parts)
+            if len(line) > 1
+        ]
+    else:
+        polygons = []
+        for rings in parts:
+            polygon = []
+            for i, ring in enumerate(rings):
+                ring = dedupe(grid(ring))
+                if len(ring) > 1 and np.all(ring[0] == ring[-1]):
+                    ring = ring[:-1]
+                signed = area(ring) if len(ring) > 2 else 0
+                if signed == 0:
+                    if i == 0:
+                        break # no exterior, no polygon
+                    continue
+                if (signed > 0) != (i == 0):
+                    ring = ring[::-1]
+                polygon.append(ring)
+            if polygon:
+                polygons.append(polygon)
+        parts = polygons
+    if not parts:
+        return None
+    return kind, parts
+
+def encode_geometry(kind, parts):
+    commands = []
+    x = y = 0
+    def moves(coords):
+        nonlocal x, y
+        for px, py in coords.tolist():
+            commands.append(zigzag(px - x))
+            commands.append(zigzag(py - y))
+            x, y = px, py
+    if kind == POINT:
+        coords = np.concatenate(parts)
+        commands.append(len(coords) << 3 | MOVE_TO)
+        moves(coords)
+    elif kind == LINESTRING:
+        for line in parts:
+            commands.append(1 << 3 | MOVE_TO)
+            moves(line[:1])
+            commands.append((len(line) - 1) << 3 | LINE_TO)
+            moves(line[1:])
+    else:
+        for rings in parts:
+            for ring in rings:
+                commands.append(1 << 3 | MOVE_TO)
+                moves(ring[:1])
+                commands.append((len(ring) - 1) << 3 | LINE_TO)
+                moves(ring[1:])
+                commands.append(1 << 3 | CLOSE_PATH)
+    return commands
+
+def encode_value(value):
+    if isinstance(value, bool):
+        return field(7, 0) + varint(int(value))
+    if isinstance(value, int):
+        if 0 <= value < 2**64:
+            return field(5, 0) + varint(value)
+        if -2**63 <= value < 0:
+            return field(6, 0) + varint(zigzag(value))
+        value = str(value)
+    if isinstance(value, float):
+        return field(3, 1) + struct.pack('<d', value)
+    return message(1, value.encode())
+
+def feature_id(feature):
+    try:
+        fid = int(feature.get('id'))
+    except (TypeError, ValueError):
+        return None
+    return fid if fid >= 0 else None
+
+def encode_layer(name, features, grid):
+    '''
+    encodes (geometry, feature) pairs as one layer, with property keys
+    and values stored once per layer
+    '''
+    keys = {}
+    values = {}
+    body = [message(1, name.encode())]
+    for geom, feature in features:
+        geometry = quantize(geom, grid)
+        if geometry is None:
+            continue
+        kind, parts = geometry
+        tags = []
+        for key, value in (feature.get('properties') or {}).items():
+            if value is None:
+                continue
+            if isinstance(value, (dict, list, tuple)):
+                value = ujson.dumps(value)
+            tags.append(keys.setdefault(key, len(keys)))
+            # typed keys keep 1, 1.0 and True apart
+            tags.append(values.setdefault((type(value), value), len(values)))
+        data = b''
+        fid = feature_id(feature)
+        if fid is not None:
+            data += field(1, 0) + varint(fid)
+        if tags:
+            data += packed(2, tags)
+        data += field(3, 0) + varint(kind)
+        data += packed(4, encode_geometry(kind, parts))
+        body.append(message(2, data))
+    body.extend(message(3, key.encode()) for key in keys)
+    body.extend(message(4, encode_value(value)) for __, value in values)
+    body.append(field(5, 0) + varint(grid.extent))
+    body.append(field(15, 0) + varint(2))
+    return message(3, b''.join(body))
+
+def encode(features, box, srid='4326', name='layer', extent=4096):
+    '''
+    encodes (geometry, feature) pairs clipped to the tile covering box
+    as a single layer vector tile
+    '''
+    return encode_layer(name, features, Grid(box, srid, extent))
+
+GEOJSON_TYPES = {
+    POINT: ('Point', 'MultiPoint'),
+    LINESTRING: ('LineString', 'MultiLineString'),
+    POLYGON: ('Polygon', 'MultiPolygon'),
+}
+
+def to_geojson(geom, grid):
+    '''
+    GeoJSON geometry of geom in integer tile coordinates, None if it
+    collapses on grid
+    '''
+    geometry = quantize(geom, grid)
+    if geometry is None:
+        return None
+    kind, parts = geometry
+    if kind == POINT:
+        coords = np.concatenate(parts).tolist()
+    elif kind == LINESTRING:
+        coords = [line.tolist() for line in parts]
+    else:
+        coords = [
+            [np.concatenate((ring, ring[:1])).tolist() for ring in rings]
+            for rings in parts
+        ]
+    single, multi = GEOJSON_TYPES[kind]
+    if len(coords) == 1:
+        return {'type': single, 'coordinates': coords[0]}
+    return {'type': multi, 'coordinates': coords}
@@ -0,0 +1,393 @@
+import os
+import mmap
+import zlib
+import threading
+from PIL import Image
+import numpy as np
+
+from .tbutils import ObjDict, LRUCache, get_digest
+
+# bytes per pixel of the raw modes that can be read straight from a mapping
+RAW_BYTES = {
+    '1;8': 1,
+    'L': 1,
+    'P': 1,
+    'LA': 2,
+    'PA': 2,
+    'I;16': 2,
+    'I;16B': 2,
+    'RGB': 3,
+    'BGR': 3,
+    'RGBA': 4,
+    'RGBa': 4,
+    'RGBX': 4,
+    'BGRA': 4,
+    'BGRX': 4,
+    'CMYK': 4,
+    'I': 4,
+    'I;32': 4,
+    'F': 4,
+    'F;32F': 4,
+}
+
+def get_raw_layout(image):
+    '''
+    returns (offset, rawmode, stride, orientation) if image data is stored
+    uncompressed in one contiguous block, None otherwise
+    '''
+    if not image.tile:
+        return None
+    iw, ih = image.size
+    codec, extents, offset, args = image.tile[0][:4]
+    if codec != 'raw':
+        return None
+    if isinstance(args, str):
+        args = (args,)
+    rawmode, stride, orientation = (tuple(args) + (0, 1))[:3]
+    try:
+        bpp = RAW_BYTES[rawmode]
+    except KeyError:
+        return None
+    stride = stride or iw * bpp
+    for tile in image.tile:
+        codec, extents, toffset, targs = tile[:4]
+        if isinstance(targs, str):
+            targs = (targs,)
+        if (
+            codec != 'raw' or tuple(targs)[:1] != (rawmode,) or
+            extents[0] != 0 or extents[2] != iw or
+            toffset != offset + extents[1] * stride
+        ):
+            return None
+    if image.tile[-1][1][3] != ih or orientation not in (1, -1):
+        return None
+    return offset, rawmode, stride, orientation
+
+# TIFF compression schemes whose blocks can be decoded independently
+DECOMPRESSORS = {
+    1: bytes,
+    8: zlib.decompress,
+    32946: zlib.decompress,
+}
+
+def get_block_layout(image):
+    '''
+    returns the internal tile (or strip) layout of a TIFF image whose
+    blocks can be decoded one by one, None otherwise
+    '''
+    tags = getattr(image, 'tag_v2', None)
+    if tags is None or not image.tile:
+        return None
+    compression = tags.get(259, 1)
+    samples = tags.get(277, 1)
+    bits = tags.get(258, (8,))
+    predictor = tags.get(317, 1)
+    args = image.tile[0][3]
+    rawmode = args if isinstance(args, str) else args[0]
+    if (
+        compression not in DECOMPRESSORS or predictor not in (1, 2) or
+        tags.get(284, 1) != 1 or set(bits) != {8} or
+        RAW_BYTES.get(rawmode) != samples
+    ):
+        return None
+    iw, ih = image.size
+    if 322 in tags:
+        width, height = tags[322], tags[323]
+        offsets, counts = tags[324], tags[325]
+        strips = False
+    else:
+        width, height = iw, tags.get(278, ih)
+        offsets, counts = tags[273], tags[279]
+        strips = True
+    if isinstance(offsets, int):
+        offsets, counts = (offsets,), (counts,)
+    return ObjDict({
+        'width': width,
+        'height': height,
+        'columns': -(-iw // width),
+        'offsets': tuple(offsets),
+        'counts': tuple(counts),
+        'strips': strips,
+        'rawmode': rawmode,
+        'samples': samples,
+        'predictor': predictor,
+        'decompress': DECOMPRESSORS[compression],
+    })
+
+def block_size(image):
+    return image.size[0] * image.size[1] * len(image.getbands())
+
+class RasterReader:
+    '''
+    Persistent handle to a source image. Uncompressed rasters are read
+    through a shared read-only memory map, touching only the rows and
+    columns of the requested window. Tiled or stripped TIFFs (deflate
+    compressed or not) are read by decoding only the internal blocks
+    that intersect the window, keeping recently decoded blocks in an LRU
+    cache so adjacent tiles can share them.
+    '''
+
+    def __init__(self, imagefile, blockcache=64 * 2**20):
+        self.file = imagefile
+        self.mtime = os.path.getmtime(imagefile)
+        self.map = None
+        self.blocks = None
+        with Image.open(imagefile) as image:
+            self.size = image.size
+            self.mode = image.mode
+            self.palette = image.getpalette() if image.mode == 'P' else None
+            self.layout = get_raw_layout(image)
+            if self.layout is None:
+                self.blocks = get_block_layout(image)
+        if self.layout is not None or self.blocks is not None:
+            with open(imagefile, 'rb') as file:
+                self.map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        # otherwise every read decodes the whole image
+        self.windowed = self.map is not None
+        if self.layout is not None:
+            self.bpp = RAW_BYTES[self.layout[1]]
+        elif self.blocks is not None:
+            self.cache = LRUCache(blockcache, sizeof=block_size)
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+
+    def rowoffset(self, y):
+        offset, rawmode, stride, orientation = self.layout
+        if orientation < 0:
+            y = self.size[1] - 1 - y
+        return offset + y * stride
+
+    def decode_block(self, index):
+        blocks = self.blocks
+        offset = blocks.offsets[index]
+        width, height = blocks.width, blocks.height
+        if blocks.strips:
+            height = min(height, self.size[1] - index * height)
+        data = blocks.decompress(self.map[offset:offset + blocks.counts[index]])
+        if blocks.predictor == 2:
+            data = np.cumsum(
+                np.frombuffer(data, np.uint8)[:width * height * blocks.samples]
+                    .reshape(height, width, blocks.samples),
+                axis=1,
+                dtype=np.uint8,
+            ).tobytes()
+        block = Image.frombytes(
+            self.mode, (width, height), data, 'raw', blocks.rawmode
+        )
+        if self.palette is not None:
+            block.putpalette(self.palette)
+        return block
+
+    def get_block(self, index):
+        block = self.cache.get(index)
+        if block is None:
+            block = self.decode_block(index)
+            self.cache.put(index, block)
+        return block
+
+    def read_blocks(self, x0, y0, x1, y1):
+        blocks = self.blocks
+        width, height = blocks.width, blocks.height
+        region = Image.new(self.mode, (x1 - x0, y1 - y0))
+        if self.palette is not None:
+            region.putpalette(self.palette)
+        for row in range(y0 // height, (y1 - 1) // height + 1):
+            for column in range(x0 // width, (x1 - 1) // width + 1):
+                region.paste(
+                    self.get_block(row * blocks.columns + column),
+                    (column * width - x0, row * height - y0)
+                )
+        return region
+
+    def read_region(self, x0, y0, x1, y1):
+        '''
+        reads a window that lies entirely within the image
+        '''
+        if self.blocks is not None:
+            return self.read_blocks(x0, y0, x1, y1)
+        if self.map is None:
+            with Image.open(self.file) as image:
+                return image.crop((x0, y0, x1, y1))
+        offset, rawmode, stride, orientation = self.layout
+        start = x0 * self.bpp
+        rowbytes = (x1 - x0) * self.bpp
+        if rowbytes == stride and orientation > 0:
+            first = self.rowoffset(y0)
+            data = self.map[first:first + stride * (y1 - y0)]
+        else:
+            data = b''.join(
+                self.map[o:o + rowbytes] for o in (
+                    self.rowoffset(y) + start for y in range(y0, y1)
+                )
+            )
+        region = Image.frombytes(
+            self.mode, (x1 - x0, y1 - y0), data, 'raw', rawmode
+        )
+        if self.palette is not None:
+            region.putpalette(self.palette)
+        return region
+
+    def read(self, bounds):
+        '''
+        reads pixel bounds (left, upper, right, lower), padding any part
+        outside the image with zeros
+        '''
+        left, upper, right, lower = bounds
+        right = max(right, left + 1)
+        lower = max(lower, upper + 1)
+        iw, ih = self.size
+        x0, y0 = max(left, 0), max(upper, 0)
+        x1, y1 = min(right, iw), min(lower, ih)
+        if (x0, y0, x1, y1) == (left, upper, right, lower):
+            return self.read_region(x0, y0, x1, y1)
+        window = Image.new(self.mode, (right - left, lower - upper))
+        if self.palette is not None:
+            window.putpalette(self.palette)
+        if x0 < x1 and y0 < y1:
+            window.paste(
+                self.read_region(x0, y0, x1, y1),
+                (x0 - left, y0 - upper)
+            )
+        return window
+
+class ImageLevel:
+    '''
+    In-memory raster level with the same read interface as RasterReader.
+    '''
+
+    def __init__(self, image):
+        self.image = image
+        self.size = image.size
+        self.windowed = True
+
+    def close(self):
+        pass
+
+    def read(self, bounds):
+        left, upper, right, lower = bounds
+        return self.image.crop(
+            (left, upper, max(right, left + 1), max(lower, upper + 1))
+        )
+
+def halve(image):
+    if image.mode in ('1', 'P', 'PA'):
+        return image.resize(
+            (-(-image.size[0] // 2), -(-image.size[1] // 2)), Image.NEAREST
+        )
+    return image.reduce(2)
+
+def scale(bounds, factor):
+    return tuple(int(round(b / factor)) for b in bounds)
+
+class Overviews:
+    '''
+    Pyramid of 2x, 4x, 8x... decimations of a raster, each built lazily
+    from the previous level on first use. Levels are kept in memory, or,
+    if directory is given, written there as uncompressed sidecar TIFFs
+    and read back through memory maps. Sidecars are named by a hash of
+    the source's absolute path, size and mtime, so sources of the same
+    name can share a directory.
+    '''
+
+    BAND = 512 # rows of the finer level read per step while building
+
+    def __init__(self, raster, tilesize, directory=None):
+        self.raster = raster
+        self.directory = directory
+        self.levels = {1: raster}
+        self.lock = threading.RLock()
+        self.maxfactor = 1
+        if directory is not None:
+            path = os.path.abspath(raster.file)
+            self.identity = get_digest('{}:{}:{}'.format(
+                path, os.path.getsize(path), raster.mtime
+            ))
+        w, h = raster.size
+        while w / self.maxfactor > tilesize[0] and h / self.maxfactor > tilesize[1]:
+            self.maxfactor *= 2
+
+    def close(self):
+        for factor, level in self.levels.items():
+            if factor > 1:
+                level.close()
+
+    def sidecar(self, factor):
+        return os.path.join(
+            self.directory,
+            '{}.{}.ovr{}.tif'.format(
+                os.path.basename(self.raster.file), self.identity, factor
+            )
+        )
+
+    def level_size(self, factor):
+        w, h = self.raster.size
+        return -(-w // factor), -(-h // factor)
+
+    def build(self, factor):
+        finer = self.get_level(factor // 2)
+        w, h = finer.size
+        level = Image.new(self.raster.mode, (-(-w // 2), -(-h // 2)))
+        if self.raster.palette is not None:
+            level.putpalette(self.raster.palette)
+        # sources that cannot be read by window are decoded once, whole
+        rows = self.BAND if finer.windowed else h
+        for y in range(0, h, rows):
+            band = finer.read((0, y, w, min(y + rows, h)))
+            level.paste(halve(band), (0, y // 2))
+        if self.directory is None:
+            return ImageLevel(level)
+        path = self.sidecar(factor)
+        tmp = '{}.{}.tmp'.format(path, os.getpid())
+        level.save(tmp, format='TIFF')
+        os.replace(tmp, path)
+        return RasterReader(path)
+
+    def get_level(self, factor):
+        try:
+            return self.levels[factor]
+        except KeyError:
+            pass
+        with self.lock:
+            if factor not in self.levels:
+                level = None
+                if self.directory is not None:
+                    path = self.sidecar(factor)
+                    if (
+                        os.path.exists(path) and
+                        os.path.getmtime(path) >= self.raster.mtime
+                    ):
+                        level = RasterReader(path)
+                        if level.size != self.level_size(factor):
+                            level.close() # left by something else
+                            level = None
+                if level is None:
+                    level = self.build(factor)
+                self.levels[factor] = level
+            return self.levels[factor]
+
+    def factor(self, bounds, tilesize):
+        '''
+        returns the largest decimation that still leaves at least tilesize
+        pixels across bounds
+        '''
+        w = bounds[2] - bounds[0]
+        h = bounds[3] - bounds[1]
+        factor = 1
+        while (
+            factor < self.maxfactor and
+            w / (factor * 2) >= tilesize[0] and h / (factor * 2) >= tilesize[1]
+        ):
+            factor *= 2
+        return factor
+
+    def select(self, bounds, tilesize):
+        '''
+        returns the coarsest level that still has at least tilesize pixels
+        across bounds, and bounds scaled to that level
+        '''
+        factor = self.factor(bounds, tilesize)
+        if factor == 1:
+            return self.raster, bounds
+        return self.get_level(factor), scale(bounds, factor)
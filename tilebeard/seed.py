@@ -0,0 +1,280 @@
+'''
+Pre-renders tiles of an on-demand layer into its tile path or MBTiles
+file, so they are served without cold misses:
+
+    python -m tilebeard seed /path/to/source.tif /path/to/tiles --zoom 0-12
+
+Tiles that already exist are skipped, so an interrupted run can be
+resumed by running it again.
+'''
+
+import os
+import sys
+import time
+import argparse
+from ast import literal_eval
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+import mercantile
+
+from .tilebeard import get_source, get_store
+from .tilesource import get_metatile, render_metatile
+
+MAXLAT = 85.0511287798
+
+def parse_zoom(value):
+    minzoom, __, maxzoom = value.partition('-')
+    return int(minzoom), int(maxzoom or minzoom)
+
+def parse_bbox(value):
+    bbox = tuple(float(b) for b in value.split(','))
+    if len(bbox) != 4:
+        raise argparse.ArgumentTypeError('bbox must be W,S,E,N')
+    return bbox
+
+def parse_option(value):
+    key, __, value = value.partition('=')
+    try:
+        value = literal_eval(value)
+    except (ValueError, SyntaxError):
+        pass # plain strings need no quotes
+    return key, value
+
+def add_arguments(parser):
+    parser.add_argument('source',
+        help='source file, or formattable string with --layer')
+    parser.add_argument('path',
+        help='tile directory or .mbtiles file (formatted as in ClusterBeard '
+        'with --layer)')
+    parser.add_argument('--layer', nargs='+', default=(),
+        help='layer arguments, as the leading members of a ClusterBeard key')
+    parser.add_argument('--zoom', type=parse_zoom, default=(0, 12),
+        help='zoom level or range, eg. 0-12 (default)')
+    parser.add_argument('--bbox', type=parse_bbox, default=None,
+        help='W,S,E,N in degrees (default: bounds of the source)')
+    parser.add_argument('--frmt', default='png',
+        help='tile format, as passed to TileBeard (default: png)')
+    parser.add_argument('--template', default='/{}/{}/{}',
+        help='tile path template, as passed to TileBeard')
+    parser.add_argument('--processes', type=int, default=None,
+        help='worker processes, 0 renders in this process '
+        '(default: number of CPUs)')
+    parser.add_argument('--metatile', type=int, default=8,
+        help='tiles rendered per job along each side (default: 8)')
+    parser.add_argument('--option', type=parse_option, action='append',
+        default=[], metavar='KEY=VALUE',
+        help='source keyword argument, eg. index=True')
+
+def get_layer(source, path, layer):
+    if not layer:
+        return source, path
+    if path.endswith('.mbtiles'):
+        return source.format(*layer), path.format(*layer)
+    return source.format(*layer), (path + '/{}' * len(layer)).format(*layer)
+
+def get_bbox(source):
+    '''
+    source bounds in degrees, clamped to the web mercator range
+    '''
+    bounds = source.get_bounds()
+    if getattr(source, 'srid', '4326') == '3857':
+        w, s = mercantile.lnglat(bounds[0], bounds[1])
+        e, n = mercantile.lnglat(bounds[2], bounds[3])
+        bounds = w, s, e, n
+    w, s, e, n = bounds
+    return max(w, -180), max(s, -MAXLAT), min(e, 180), min(n, MAXLAT)
+
+def tile_range(bbox, z):
+    '''
+    returns the first and last column and row covering bbox at zoom z
+    '''
+    w, s, e, n = bbox
+    first = mercantile.tile(w, min(n, MAXLAT), z)
+    last = mercantile.tile(e, max(s, -MAXLAT), z)
+    top = 2**z - 1
+    return (
+        max(first.x, 0), max(first.y, 0),
+        min(last.x, top), min(last.y, top),
+    )
+
+def count_tiles(bbox, zooms):
+    total = 0
+    for z in zooms:
+        x0, y0, x1, y1 = tile_range(bbox, z)
+        total += (x1 - x0 + 1) * (y1 - y0 + 1)
+    return total
+
+def get_jobs(store, bbox, zooms, metatile):
+    '''
+    yields ((z, x, y, size, wanted), skipped) for each metatile covering
+    bbox, wanted being its tiles within bbox that are not stored yet and
+    skipped the number of those that are
+    '''
+    for z in zooms:
+        x0, y0, x1, y1 = tile_range(bbox, z)
+        size = get_metatile(z, 0, 0, metatile)[2]
+        for my in range(y0 - y0 % size, y1 + 1, size):
+            for mx in range(x0 - x0 % size, x1 + 1, size):
+                wanted = set()
+                skipped = 0
+                for y in range(max(my, y0), min(my + size, y1 + 1)):
+                    for x in range(max(mx, x0), min(mx + size, x1 + 1)):
+                        if store.exists(store.address((z, x, y))):
+                            skipped += 1
+                        else:
+                            wanted.add((z, x, y))
+                yield (z, mx, my, size, wanted), skipped
+
+class Progress:
+    '''
+    Reports tiles done and throughput to stderr, at most once a second.
+    '''
+
+    def __init__(self, total, stream=sys.stderr, interval=1):
+        self.total = total
+        self.stream = stream
+        self.interval = interval
+        self.start = self.last = time.monotonic()
+        self.done = 0
+        self.skipped = 0
+        self.rendered = 0
+        self.written = 0
+
+    def update(self, done, rendered=0, written=0, force=False):
+        self.done += done
+        self.skipped += done - rendered
+        self.rendered += rendered
+        self.written += written
+        now = time.monotonic()
+        if force or now - self.last >= self.interval:
+            self.last = now
+            self.report(now)
+
+    def report(self, now):
+        elapsed = now - self.start
+        rate = self.rendered / elapsed if elapsed else 0
+        self.stream.write(
+            '\r{}/{} tiles ({:.1f}%), {} rendered, {} skipped, '
+            '{:.1f} tiles/s '.format(
+                self.done, self.total,
+                100 * self.done / self.total if self.total else 100,
+                self.rendered, self.skipped, rate,
+            )
+        )
+        self.stream.flush()
+
+    def finish(self):
+        self.report(time.monotonic())
+        self.stream.write('\n')
+
+def record_extent(store, bbox, zooms):
+    '''
+    widens the bounds and zoom range in the metadata of an MBTiles store
+    to cover bbox and zooms
+    '''
+    metadata = store.get_metadata()
+    try:
+        old = [float(b) for b in metadata['bounds'].split(',')]
+        bbox = (
+            min(old[0], bbox[0]), min(old[1], bbox[1]),
+            max(old[2], bbox[2]), max(old[3], bbox[3]),
+        )
+    except (KeyError, ValueError, IndexError):
+        pass
+    minzoom, maxzoom = min(zooms), max(zooms)
+    try:
+        minzoom = min(minzoom, int(metadata['minzoom']))
+        maxzoom = max(maxzoom, int(metadata['maxzoom']))
+    except (KeyError, ValueError):
+        pass
+    store.set_metadata({
+        'bounds': ','.join('{:.6f}'.format(b) for b in bbox),
+        'minzoom': minzoom,
+        'maxzoom': maxzoom,
+    })
+
+def write(store, tiles):
+    write_many = getattr(store, 'write_many', None)
+    if write_many is not None:
+        write_many(tiles)
+        return
+    for address, content in tiles.items():
+        store.write(address, content)
+
+def seed(source, store, bbox, zooms, processes=None, metatile=8,
+    progress=None):
+    '''
+    renders all missing tiles of source within bbox at zooms into store
+    '''
+    if progress is None:
+        progress = Progress(count_tiles(bbox, zooms))
+    if hasattr(store, 'set_metadata'):
+        record_extent(store, bbox, zooms)
+
+    def save(tiles, wanted):
+        batch = {
+            store.address(key): content
+            for key, content in tiles.items() if key in wanted
+        }
+        write(store, batch)
+        progress.update(len(wanted), len(wanted), len(batch))
+
+    if processes == 0:
+        for (z, x, y, size, wanted), skipped in get_jobs(
+            store, bbox, zooms, metatile
+        ):
+            progress.update(skipped)
+            if wanted:
+                save(source.render_metatile(z, x, y, size), wanted)
+        progress.update(0, force=True)
+        return progress
+
+    processes = processes or os.cpu_count()
+    executor = ProcessPoolExecutor(max_workers=processes)
+    pending = {}
+
+    def collect(futures):
+        for future in futures:
+            save(future.result(), pending.pop(future))
+
+    try:
+        for (z, x, y, size, wanted), skipped in get_jobs(
+            store, bbox, zooms, metatile
+        ):
+            progress.update(skipped)
+            if not wanted:
+                continue
+            future = executor.submit(
+                render_metatile, source.spec, z, x, y, size
+            )
+            pending[future] = wanted
+            if len(pending) >= 2 * processes: # keep workers busy, not more
+                collect(wait(pending, return_when=FIRST_COMPLETED)[0])
+        collect(wait(pending)[0])
+        progress.update(0, force=True)
+    finally:
+        for future in pending:
+            future.cancel()
+        executor.shutdown()
+    return progress
+
+def main(args):
+    sourcefile, path = get_layer(args.source, args.path, args.layer)
+    source = get_source(sourcefile, None, args.frmt, dict(args.option))
+    store = get_store(path, args.template + '.' + args.frmt, args.frmt)
+    bbox = args.bbox or get_bbox(source)
+    zooms = range(args.zoom[0], args.zoom[1] + 1)
+    progress = Progress(count_tiles(bbox, zooms))
+    try:
+        seed(source, store, bbox, zooms, args.processes, args.metatile, progress)
+    except KeyboardInterrupt:
+        progress.finish()
+        sys.stderr.write('interrupted, run again to resume\n')
+        return 1
+    finally:
+        store.close()
+    progress.finish()
+    elapsed = time.monotonic() - progress.start
+    sys.stderr.write('{} tiles rendered in {:.1f}s\n'.format(
+        progress.rendered, elapsed
+    ))
+    return 0
@@ -1,5 +1,10 @@
 from PIL import Image
 from io import BytesIO
+import os
+import time
+import hashlib
+from collections import OrderedDict
+from threading import Lock
 import mercantile
 
 # decorator for PIL operations for applying to bytes instead of Image objects
@@ -27,8 +32,18 @@ def constructable_filter(func):
         def wrapped(img):
             return func(img, *args, **kwargs)
 
+        return wrapped
+
     return constructor
 
+def get_digest(content):
+    '''
+    content hash naming deduplicated tiles, also used as their ETag
+    '''
+    if isinstance(content, str):
+        content = content.encode()
+    return hashlib.blake2b(content, digest_size=16).hexdigest()
+
 # dict to object
 class ObjDict(dict):
 
@@ -47,5 +62,228 @@ class ObjDict(dict):
         if kwargs != {}:
             self.__dict__.update(kwargs)
 
+class LRUCache:
+    '''
+    Thread-safe least recently used mapping, bounded by the total size
+    of its values as measured by sizeof. If given, on_evict is called
+    with each evicted key and value.
+    '''
+
+    def __init__(self, maxsize, sizeof=len, on_evict=None):
+        self.maxsize = maxsize
+        self.sizeof = sizeof
+        self.on_evict = on_evict
+        self.data = OrderedDict()
+        self.size = 0
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.data)
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                value, size = self.data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self.data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        size = self.sizeof(value)
+        if size > self.maxsize:
+            return
+        evicted = []
+        with self.lock:
+            try:
+                self.size -= self.data.pop(key)[1]
+            except KeyError:
+                pass
+            self.data[key] = (value, size)
+            self.size += size
+            while self.size > self.maxsize:
+                old, (oldvalue, oldsize) = self.data.popitem(last=False)
+                self.size -= oldsize
+                self.evictions += 1
+                evicted.append((old, oldvalue))
+        if self.on_evict is not None:
+            for old, oldvalue in evicted:
+                self.on_evict(old, oldvalue)
+
+    def pop(self, key, default=None):
+        with self.lock:
+            try:
+                value, size = self.data.pop(key)
+            except KeyError:
+                return default
+            self.size -= size
+            return value
+
+    def items(self):
+        with self.lock:
+            return [(key, value) for key, (value, size) in self.data.items()]
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+            self.size = 0
+
+    def stats(self):
+        return {
+            'entries': len(self.data),
+            'size': self.size,
+            'maxsize': self.maxsize,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+class NegativeCache:
+    '''
+    Remembers keys known to have no tile for ttl seconds, keeping at most
+    maxsize of them. If file is given, entries are reloaded from it on
+    init, so they survive restarts. New entries are queued by add() and
+    appended in batches by flush(), which does the I/O and is meant to
+    run in an executor once due() says so; the file is rewritten with
+    only the live entries when it holds many more lines than that.
+    '''
+
+    def __init__(self, ttl, file=None, maxsize=2**20, batch=256,
+        flush_interval=5, compact=10000):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.batch = batch
+        self.flush_interval = flush_interval
+        self.compact_after = compact
+        self.entries = OrderedDict()
+        self.pending = []
+        self.flushed = time.monotonic()
+        self.lock = Lock() # entries and pending, shared with flush()
+        self.io = Lock() # the file
+        self.path = file
+        self.file = None
+        if file is not None:
+            self.load()
+
+    def load(self):
+        now = time.time()
+        try:
+            with open(self.path, 'r') as f:
+                for line in f:
+                    key, __, expires = line.rstrip('\n').rpartition('\t')
+                    try:
+                        if float(expires) > now:
+                            self.entries[key] = float(expires)
+                    except ValueError:
+                        continue
+        except FileNotFoundError:
+            pass
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+        self.compact(list(self.entries.items()))
+
+    def compact(self, entries):
+        '''
+        rewrites the file with entries, the live (key, expires) pairs
+        '''
+        now = time.time()
+        with self.io:
+            if self.file is not None:
+                self.file.close()
+            tmp = '{}.{}.tmp'.format(self.path, os.getpid())
+            with open(tmp, 'w') as f:
+                for key, expires in entries:
+                    if expires > now:
+                        f.write('{}\t{}\n'.format(key, expires))
+            os.replace(tmp, self.path)
+            self.file = open(self.path, 'a')
+            self.lines = len(entries)
+
+    @staticmethod
+    def keystring(key):
+        return '/'.join(str(k) for k in key)
+
+    def __contains__(self, key):
+        key = self.keystring(key)
+        expires = self.entries.get(key)
+        if expires is None:
+            return False
+        if time.time() > expires:
+            with self.lock:
+                self.entries.pop(key, None)
+            return False
+        return True
+
+    def add(self, key):
+        key = self.keystring(key)
+        expires = time.time() + self.ttl
+        with self.lock:
+            self.entries[key] = expires
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+            if self.path is not None:
+                self.pending.append('{}\t{}\n'.format(key, expires))
+
+    def due(self):
+        '''
+        whether enough entries are queued, or for long enough, to flush
+        '''
+        return bool(self.pending) and (
+            len(self.pending) >= self.batch or
+            time.monotonic() - self.flushed >= self.flush_interval
+        )
+
+    def flush(self):
+        '''
+        appends queued entries to the file, or compacts it once it holds
+        over 4 lines per live entry
+        '''
+        with self.lock:
+            lines, self.pending = self.pending, []
+            self.flushed = time.monotonic()
+            if not lines or self.file is None:
+                return
+            entries = None
+            if self.lines + len(lines) > max(
+                self.compact_after, 4 * len(self.entries)
+            ):
+                entries = list(self.entries.items())
+        if entries is not None:
+            self.compact(entries)
+            return
+        with self.io:
+            if self.file is not None:
+                self.file.write(''.join(lines))
+                self.file.flush()
+                self.lines += len(lines)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.pending = []
+        if self.file is not None:
+            with self.io:
+                self.file.truncate(0)
+                self.lines = 0
+
+    def close(self):
+        self.flush()
+        with self.io:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
 class TileNotFound(Exception):
     pass
+
+class UpstreamError(Exception):
+    pass
@@ -1,10 +1,21 @@
 import os
+import re
 import gzip
+import time
 import asyncio
+import threading
+from functools import partial
+from email.utils import parsedate_to_datetime
 from wsgiref.handlers import format_date_time
 import aiohttp
+import ujson
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
-from .tbutils import TileNotFound
+from .tbutils import TileNotFound, UpstreamError, get_digest
+from .tilesource import get_metatile
 
 MIMETYPES = {
     'png': 'image/png',
@@ -28,25 +39,88 @@ DEFAULT_HEADERS = {
     'Cache-Control': 'public',
 }
 
+# file suffixes of precompressed variants, in order of preference
+VARIANTS = {
+    'br': '.br',
+    'gzip': '.gz',
+}
+
+def compress(content, encoding, level):
+    if isinstance(content, str):
+        content = content.encode()
+    if encoding == 'br':
+        return brotli.compress(content, quality=level)
+    return gzip.compress(content, level)
+
+def get_encodings(compresslevel=0, brotli_quality=0):
+    '''
+    enabled content encodings and their compression levels
+    '''
+    encodings = {}
+    if brotli_quality:
+        if brotli is None:
+            raise ValueError('brotli compression requires the brotli package')
+        encodings['br'] = brotli_quality
+    if 0 < compresslevel < 10:
+        encodings['gzip'] = compresslevel
+    return encodings
+
+def choose_encoding(accept, encodings):
+    '''
+    picks the preferred enabled encoding the client accepts, None if the
+    response should not be compressed
+    '''
+    if not encodings or not accept:
+        return None
+    accepted = {}
+    for item in accept.lower().split(','):
+        name, *params = item.strip().split(';')
+        q = 1
+        for param in params:
+            key, __, value = param.strip().partition('=')
+            if key == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0
+        accepted[name.strip()] = q
+    for encoding in VARIANTS:
+        if encoding in encodings and accepted.get(encoding, accepted.get('*', 0)) > 0:
+            return encoding
+    return None
 
-def __readfile(path, mode):
+
+def _readfile(path, mode):
     with open(path, 'r'+mode) as file:
         return file.read()
 
-def __writefile(path, content, mode):
+def _writefile(path, content, mode):
     with open(path, 'w'+mode) as file:
         file.write(content)
 
+def _replacefile(path, content, mode):
+    # readers see either the old file or the whole new one
+    tmp = '{}.{}.{}.tmp'.format(path, os.getpid(), threading.get_ident())
+    try:
+        _writefile(tmp, content, mode)
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        raise
+
 def getmode(frmt):
     if frmt in TEXT_FORMATS:
         return ''
     return 'b'
 
 async def aioread(path, loop, executor, mode):
-    return await loop.run_in_executor(executor, __readfile, path, mode)
+    return await loop.run_in_executor(executor, _readfile, path, mode)
 
 async def aiowrite(path, content, loop, executor, mode):
-    await loop.run_in_executor(executor, __writefile, path, content, mode)
+    await loop.run_in_executor(executor, _writefile, path, content, mode)
 
 def get_etag_from_file(timestamp, file):
     return str(round(100 * (timestamp % (3600 * 48)))) + ''.join(file.split(os.path.sep)[-3:])
@@ -54,6 +128,15 @@ def get_etag_from_file(timestamp, file):
 def get_etag_from_args(*args):
     return ''.join([str(a) for a in args])
 
+def encode_etag(etag, encoding):
+    '''
+    ETag of the encoding's compressed representation of a tile, since
+    strong validators must differ between content codings
+    '''
+    if etag.endswith('"'): # quoted by an upstream, eg. W/"abc"
+        return '{}-{}"'.format(etag[:-1], encoding)
+    return '{}-{}'.format(etag, encoding)
+
 def get_headers(string):
     ext = string.split('.')[-1].lower()
     return {
@@ -61,153 +144,600 @@ def get_headers(string):
     }
     return headers, __getmode(ext)
 
+def get_cache_meta(headers, ttl=None):
+    '''
+    validators and expiry time of an upstream response, from its
+    Cache-Control/Expires headers or, failing those, from ttl
+    '''
+    now = time.time()
+    directives = {}
+    for directive in headers.get('Cache-Control', '').lower().split(','):
+        name, __, value = directive.strip().partition('=')
+        directives[name] = value.strip('"')
+    expires = None
+    if 'no-cache' in directives or 'no-store' in directives:
+        expires = now
+    elif 's-maxage' in directives or 'max-age' in directives:
+        try:
+            maxage = int(directives.get('s-maxage') or directives['max-age'])
+            expires = now + maxage - int(headers.get('Age', 0))
+        except ValueError:
+            expires = now
+    elif 'Expires' in headers:
+        try:
+            expires = parsedate_to_datetime(headers['Expires']).timestamp()
+        except (TypeError, ValueError):
+            expires = now
+    elif ttl is not None:
+        expires = now + ttl
+    return {
+        'etag': headers.get('ETag'),
+        'last_modified': headers.get('Last-Modified'),
+        'expires': expires,
+        'fetched': now,
+    }
+
+def get_validator_headers(meta):
+    headers = {
+        'Last-Modified': meta.get('last_modified') or format_date_time(meta['fetched']),
+    }
+    if meta.get('etag'):
+        headers['ETag'] = meta['etag']
+    if meta.get('expires') is not None:
+        headers['Expires'] = format_date_time(meta['expires'])
+    return headers
+
+class FileStore:
+    '''
+    Tiles stored as files under path, addressed by their file paths.
+    With dedupe=True, each distinct tile is stored once as a blob named
+    by its hash (under path/.blobs) and tile paths are symlinks to it.
+    Files are written to a temporary name and renamed into place.
+    '''
+
+    def __init__(self, path, template, mode, dedupe=False):
+        self.path = path
+        self.template = template
+        self.mode = mode
+        self.dedupe = dedupe
+        self.dirs = set() # directories known to exist
+        self.formatter = (
+            path.replace('{', '{{').replace('}', '}}') + template
+        ).format
+
+    def address(self, key):
+        return self.formatter(*key)
+
+    def read(self, address):
+        return _readfile(address, self.mode)
+
+    def exists(self, address):
+        return os.path.exists(address)
+
+    def scan(self):
+        '''
+        yields (key, mtime, size) of every tile under path
+        '''
+        pattern = re.compile('^{}$'.format('([^/]+?)'.join(
+            re.escape(part) for part in self.template.split('{}')
+        )))
+        for root, dirs, files in os.walk(self.path):
+            for name in files:
+                address = os.path.join(root, name)
+                match = pattern.match(address[len(self.path):])
+                if match is None:
+                    continue
+                stat = os.stat(address)
+                yield match.groups(), stat.st_mtime, stat.st_size
+
+    def makedirs(self, address):
+        directory = os.path.dirname(address)
+        if directory not in self.dirs:
+            os.makedirs(directory, exist_ok=True)
+            self.dirs.add(directory)
+
+    def write(self, address, content):
+        self.makedirs(address)
+        if not self.dedupe:
+            _replacefile(address, content, self.mode)
+            return
+        blob = self.blob(get_digest(content))
+        if not os.path.exists(blob):
+            self.makedirs(blob)
+            _replacefile(blob, content, self.mode)
+        tmp = '{}.{}.{}.tmp'.format(address, os.getpid(), threading.get_ident())
+        os.symlink(os.path.relpath(blob, os.path.dirname(address)), tmp)
+        os.replace(tmp, address)
+
+    def blob(self, digest):
+        return os.path.join(self.path, '.blobs', digest[:2], digest)
+
+    def digest(self, address):
+        '''
+        hash of a deduplicated tile, None if it is not one
+        '''
+        if not self.dedupe:
+            return None
+        try:
+            return os.path.basename(os.readlink(address))
+        except OSError:
+            return None
+
+    def read_meta(self, address):
+        try:
+            with open(address + '.meta', 'r') as file:
+                return ujson.loads(file.read())
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def write_meta(self, address, meta):
+        self.makedirs(address)
+        _replacefile(address + '.meta', ujson.dumps(meta), '')
+
+    def read_variant(self, address, encoding):
+        digest = self.digest(address)
+        if digest is not None: # variants of a blob never go out of date
+            return _readfile(self.blob(digest) + VARIANTS[encoding], 'b')
+        variant = address + VARIANTS[encoding]
+        if os.path.getmtime(variant) < os.path.getmtime(address):
+            raise FileNotFoundError(variant) # outdated by the tile itself
+        return _readfile(variant, 'b')
+
+    def write_variant(self, address, encoding, content):
+        digest = self.digest(address)
+        if digest is not None:
+            address = self.blob(digest)
+        _replacefile(address + VARIANTS[encoding], content, 'b')
+
+    def modified(self, address):
+        if self.dedupe: # when the link was made, blobs are shared
+            return os.lstat(address).st_mtime
+        return os.path.getmtime(address)
+
+    def etag(self, timestamp, address):
+        digest = self.digest(address)
+        if digest is not None:
+            return digest
+        return get_etag_from_file(timestamp, address)
+
+    def close(self):
+        pass
+
+class Upstream:
+    '''
+    HTTP client for proxied tiles: one long-lived session with a per-host
+    connection limit and socket timeouts, and bounded retries with
+    exponential backoff. A session passed in is used as is and left open
+    on close.
+    '''
+
+    RETRY_STATUS = (429, 500, 502, 503, 504)
+
+    def __init__(self, session=None, connections=8, timeout=10, retries=2,
+        backoff=.5, ttl=None, max_stale=None):
+        self.session = session
+        self.owned = session is None
+        self.connections = connections
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.ttl = ttl
+        self.max_stale = max_stale
+
+    def get_session(self):
+        if self.session is None:
+            self.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(
+                    limit=0, limit_per_host=self.connections
+                ),
+                timeout=aiohttp.ClientTimeout(
+                    total=None,
+                    sock_connect=self.timeout,
+                    sock_read=self.timeout,
+                ),
+            )
+        return self.session
+
+    async def request(self, url, meta=None):
+        '''
+        GETs url, conditionally if meta holds validators of a cached copy,
+        and returns (content, meta); content is None if the cached copy
+        is still valid
+        '''
+        headers = {}
+        if meta is not None:
+            if meta.get('etag'):
+                headers['If-None-Match'] = meta['etag']
+            if meta.get('last_modified'):
+                headers['If-Modified-Since'] = meta['last_modified']
+        session = self.get_session()
+        for attempt in range(self.retries + 1):
+            try:
+                async with session.get(url, headers=headers) as response:
+                    if response.status == 404:
+                        raise TileNotFound
+                    if response.status == 200:
+                        content = await response.read()
+                        return content, get_cache_meta(response.headers, self.ttl)
+                    if response.status == 304 and meta is not None:
+                        fresh = get_cache_meta(response.headers, self.ttl)
+                        for validator in ('etag', 'last_modified'):
+                            fresh[validator] = fresh[validator] or meta.get(validator)
+                        return None, fresh
+                    error = UpstreamError('{} returned {}'.format(
+                        url, response.status
+                    ))
+                    if response.status not in self.RETRY_STATUS:
+                        raise error
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                error = UpstreamError('{} failed: {!r}'.format(url, e))
+            if attempt < self.retries:
+                await asyncio.sleep(self.backoff * 2 ** attempt)
+        raise error
+
+    async def close(self):
+        if self.owned and self.session is not None:
+            await self.session.close()
+            self.session = None
+
+class Coalescer:
+    '''
+    Deduplicates concurrent work: callers asking for the same key while
+    a job for it is in flight all await that one job, and share its
+    result or exception.
+    '''
+
+    def __init__(self):
+        self.pending = {}
+
+    def __call__(self, key, func, *args):
+        try:
+            future = self.pending[key]
+        except KeyError:
+            future = asyncio.ensure_future(func(*args))
+            self.pending[key] = future
+            future.add_done_callback(partial(self.done, key))
+        # a cancelled waiter must not cancel the job for everyone else
+        return asyncio.shield(future)
+
+    def done(self, key, future):
+        if self.pending.get(key) is future:
+            del self.pending[key]
+        if not future.cancelled():
+            future.exception() # retrieved here in case all waiters are gone
+
+def passthrough(key, func, *args):
+    return asyncio.ensure_future(func(*args))
+
+class TileRequest:
+    '''
+    State of a single tile request: the key, store address and upstream
+    url of the tile, its (mtime, size) if already known, and the
+    validators found for it on top of its layer's headers.
+    '''
+    __slots__ = ('key', 'file', 'url', 'stat', 'headers')
+
+    def __init__(self, key, file=None, url=None, stat=None):
+        self.key = key
+        self.file = file
+        self.url = url
+        self.stat = stat
+        self.headers = {}
+
 class Tile:
     '''
-    Base class for tile handling.
+    Base class for tile handling. One instance serves all tiles of a
+    layer, built once with everything that is the same for all of them;
+    each request only brings its TileRequest.
     '''
 
-    def __init__(self, *args):
-        self.file, self.format, self.executor, compresslevel, *__ = args
+    def __init__(self, *args, inflight=passthrough, store=None,
+        encodings=None):
+        self.format, self.executor, compresslevel, *__ = args
+        self.inflight = inflight
         self.headers = dict(DEFAULT_HEADERS)
         self.mode = getmode(self.format)
-        self.respond = self.makerespond(compresslevel)
+        # precompressed variants can be kept next to the tiles
+        self.variants = store is not None and hasattr(store, 'read_variant')
+        self.dedupe = getattr(store, 'dedupe', False)
+        if store is None:
+            store = FileStore('', '', self.mode)
+        self.store = store
+        if encodings is None:
+            encodings = get_encodings(compresslevel)
+        self.encodings = encodings
+        if encodings:
+            self.headers['Vary'] = 'Accept-Encoding'
 
-    async def read(self):
-        loop = asyncio.get_event_loop()
-        return await aioread(self.file, loop, self.executor, self.mode)
+    def load(self, file, encoding=None, content=None):
+        '''
+        returns the tile at file (or content, if given) in encoding,
+        reading or keeping its stored variant where there is one
+        '''
+        if encoding is None:
+            return self.store.read(file) if content is None else content
+        if self.variants:
+            try:
+                return self.store.read_variant(file, encoding)
+            except FileNotFoundError:
+                pass
+        if content is None:
+            content = self.store.read(file)
+        return self.encode(file, content, encoding)
 
-    async def write(self, content):
+    async def read(self, file, encoding=None, content=None):
         loop = asyncio.get_event_loop()
-        dir = os.path.dirname(self.file)
-        try:
-            os.makedirs(dir)
-        except FileExistsError:
-            pass
-        await aiowrite(self.file, content, loop, self.executor, self.mode)
+        return await loop.run_in_executor(
+            self.executor, self.load, file, encoding, content
+        )
 
-    def makerespond(self, compresslevel):
-        if 0 < compresslevel < 10:
-            self.headers.update({
-                'Content-Encoding': 'gzip',
-                'Vary': 'Accept-Encoding',
-            })
-            def respond(content):
-                content = gzip.compress(
-                    content,
-                    compresslevel = compresslevel
+    def store_content(self, address, content):
+        '''
+        writes the tile at address and its compressed variants
+        '''
+        self.store.write(address, content)
+        if self.variants:
+            for encoding, level in self.encodings.items():
+                self.store.write_variant(
+                    address, encoding, compress(content, encoding, level)
                 )
-                try:
-                    self.headers['Content-Length']
-                except KeyError:
-                    self.headers.update({
-                        'Content-Length': len(content)
-                    })
-                return 200, self.headers, content
-        else:
-            def respond(content):
-                return 200, self.headers, content
 
-        return respond
+    async def write(self, address, content):
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(
+            self.executor, self.store_content, address, content
+        )
+
+    async def digest(self, file):
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(
+            self.executor, self.store.digest, file
+        )
+
+    def encode(self, file, content, encoding):
+        body = compress(content, encoding, self.encodings[encoding])
+        if self.variants:
+            try:
+                self.store.write_variant(file, encoding, body)
+            except OSError:
+                pass # eg. a read-only pyramid, compressed on every request
+        return body
+
+    def respond(self, req, body, encoding=None):
+        headers = {**self.headers, **req.headers}
+        if encoding is not None:
+            headers['Content-Encoding'] = encoding
+            if headers.get('ETag'):
+                headers['ETag'] = encode_etag(headers['ETag'], encoding)
+        if isinstance(body, bytes):
+            headers['Content-Length'] = len(body)
+        return 200, headers, body
 
 class FileTile(Tile):
     '''
-    Extends Tile class to a callable object that calls self.modified on init.
+    Extends Tile class to handle premade tiles. If the stat (mtime, size)
+    of a tile is known from a tile index, validators are built without
+    touching the file. Otherwise the file is stat'ed in the executor, in
+    the same job that reads it.
     '''
-    def __init__(self, *args):
-        super(FileTile, self).__init__(*args)
-        self.headers.update(get_headers(self.file))
-        asyncio.ensure_future(self.modified())
+    def __init__(self, *args, **kwargs):
+        super(FileTile, self).__init__(*args, **kwargs)
+        self.headers.update(get_headers(self.format))
 
-    async def modified(self):
-        timestamp = os.path.getmtime(self.file)
+    def validators(self, req):
+        if req.stat is not None:
+            timestamp = req.stat[0]
+        else:
+            timestamp = self.store.modified(req.file)
         lastmod = format_date_time(timestamp)
-        etag = get_etag_from_file(timestamp, self.file)
-        self.headers.update({
-            'Last-Modified': lastmod,
-            'ETag': etag,
-        })
+        etag = self.store.etag(timestamp, req.file)
+        req.headers['Last-Modified'] = lastmod
+        req.headers['ETag'] = etag
         return lastmod, etag
 
-    async def __call__(self):
-        content = await self.read()
-        return self.respond(content)
+    def load_validated(self, req, encoding=None):
+        if 'ETag' not in req.headers:
+            self.validators(req)
+        return self.load(req.file, encoding)
+
+    async def modified(self, req):
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self.executor, self.validators, req)
+
+    async def __call__(self, req, encoding=None):
+        loop = asyncio.get_event_loop()
+        body = await loop.run_in_executor(
+            self.executor, self.load_validated, req, encoding
+        )
+        return self.respond(req, body, encoding)
 
 class ProxyTile(Tile):
     '''
     Extends Tile class to handle remote tile urls and cache content locally.
     '''
 
-    def __init__(self, *args):
-        path, frmt, executor, compresslevel, self.url, self.session, *__ = args
-        super(ProxyTile, self).__init__(path, frmt, executor, compresslevel)
-        self.headers.update(get_headers(self.url))
-        self.proxypass = self.makepass()
+    def __init__(self, *args, **kwargs):
+        super(ProxyTile, self).__init__(*args, **kwargs)
+        frmt, executor, compresslevel, self.upstream, *__ = args
+        self.headers.update(get_headers(self.format))
 
-    def makepass(self):
-        if self.file is None:
-            async def proxypass():
-                async with self.session.get(self.url) as response:
-                    if response.status == 404:
-                        raise TileNotFound
-                    return await response.read()
-        else:
-            async def proxypass():
-                try:
-                    content = await self.read()
-                    return content
-                except FileNotFoundError:
-                    if self.session is None:
-                        async with aiohttp.request('GET', self.url) as response:
-                            content = await response.read()
-                    else:
-                        async with self.session.get(self.url) as response:
-                            content = await response.read()
-                    await self.write(content)
-                    return content
-        return proxypass
-
-    async def __call__(self):
-        content = await self.proxypass()
-        return self.respond(content)
+    def load_cached(self, file):
+        return self.store.read(file), self.store.read_meta(file)
+
+    def save(self, file, content, meta):
+        if content is not None:
+            self.store_content(file, content)
+        self.store.write_meta(file, meta)
+
+    def load_validators(self, file):
+        meta = self.store.read_meta(file)
+        if meta is not None and self.dedupe: # the hash replaces their ETag
+            meta = dict(meta, etag=self.store.digest(file))
+        return meta
+
+    async def read_meta(self, file):
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(
+            self.executor, self.load_validators, file
+        )
+
+    async def modified(self, req):
+        '''
+        validators of the cached copy, without asking the upstream
+        '''
+        meta = None if req.file is None else await self.read_meta(req.file)
+        if meta is None:
+            return None, None
+        headers = get_validator_headers(meta)
+        req.headers.update(headers)
+        return headers['Last-Modified'], headers.get('ETag')
+
+    async def fetch_and_write(self, file, url, meta=None, cached=None):
+        content, meta = await self.upstream.request(url, meta)
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(self.executor, self.save, file, content, meta)
+        return cached if content is None else content, meta
+
+    async def proxypass(self, req):
+        if req.file is None:
+            return await self.inflight(req.url, self.upstream.request, req.url)
+        loop = asyncio.get_event_loop()
+        try:
+            content, meta = await loop.run_in_executor(
+                self.executor, self.load_cached, req.file
+            )
+        except FileNotFoundError:
+            return await self.inflight(
+                req.url, self.fetch_and_write, req.file, req.url
+            )
+        if meta is None or meta.get('expires') is None:
+            return content, meta
+        stale = time.time() - meta['expires']
+        if stale < 0:
+            return content, meta
+        revalidation = self.inflight(
+            (req.url, 'revalidate'), self.fetch_and_write,
+            req.file, req.url, meta, content,
+        )
+        max_stale = self.upstream.max_stale
+        if max_stale is None or stale < max_stale:
+            # serve stale, the shielded revalidation keeps running
+            revalidation.cancel()
+            return content, meta
+        return await revalidation
+
+    async def __call__(self, req, encoding=None):
+        content, meta = await self.proxypass(req)
+        if meta is not None:
+            req.headers.update(get_validator_headers(meta))
+        if self.dedupe and content is not None:
+            req.headers['ETag'] = get_digest(content)
+        if encoding is not None:
+            content = await self.read(req.file, encoding, content)
+        return self.respond(req, content, encoding)
 
 class LazyTile(Tile):
     '''
     Extends Tile class to handle tiles generated on demand.
+    With metatile > 1, a missing tile is rendered together with its
+    neighbours in one metatile job and all of them are cached at once.
+    Validators come from the source's modification time, taken from the
+    request's stat if the caller already knows it. With a deduplicating
+    store the ETag is always the tile's hash, so it is only set once the
+    tile is stored or rendered.
     '''
 
-    def __init__(self, *args):
-        path, frmt, executor, compresslevel, *__, self.source, self.key = args
-        super(LazyTile, self).__init__(path, frmt, executor, compresslevel)
-        self.key = tuple(int(x) for x in self.key)
+    def __init__(self, *args, metatile=1, **kwargs):
+        super(LazyTile, self).__init__(*args, **kwargs)
+        *__, self.source = args
+        self.metatile = metatile
+        # in-flight jobs are shared between layers, so keys name the source
+        self.layer = getattr(self.source, 'spec', self.source)
         self.headers.update(get_headers(self.source.format))
-        self.lazypass = self.makepass()
-        asyncio.ensure_future(self.modified())
+        if metatile > 1 and hasattr(self.source, 'metatile'):
+            self.render = self.render_from_metatile
+        else:
+            self.render = self.render_tile
 
-    async def modified(self):
-        timestamp = await self.source.modified()
+    async def modified(self, req):
+        if req.stat is not None:
+            timestamp = req.stat[0]
+        else:
+            timestamp = await self.source.modified()
         lastmod = format_date_time(timestamp)
-        etag = get_etag_from_args(timestamp, *self.key)
-        self.headers.update({
-            'Last-Modified': lastmod,
-            'ETag': etag,
-        })
+        req.headers['Last-Modified'] = lastmod
+        if req.file is not None and self.dedupe:
+            etag = await self.digest(req.file)
+        else:
+            etag = get_etag_from_args(timestamp, *req.key)
+        if etag is not None:
+            req.headers['ETag'] = etag
         return lastmod, etag
 
-    def makepass(self):
-        if self.file is None:
-            async def lazypass():
-                return await self.source(*self.key)
+    async def render_and_write(self, file, key):
+        content = await self.source(*key)
+        await self.write(file, content)
+        return content
+
+    async def render_tile(self, req):
+        return await self.inflight(
+            (self.layer, req.key), self.render_and_write, req.file, req.key
+        )
+
+    def store_metatile(self, tiles):
+        write_many = getattr(self.store, 'write_many', None)
+        if write_many is not None and not self.variants:
+            write_many({
+                self.store.address(key): content
+                for key, content in tiles.items()
+            })
+            return
+        for key, content in tiles.items():
+            self.store_content(self.store.address(key), content)
+
+    async def render_metatile_and_write(self, z, x, y, size):
+        tiles = await self.source.metatile(z, x, y, size)
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(self.executor, self.store_metatile, tiles)
+        return tiles
+
+    async def render_from_metatile(self, req):
+        z = req.key[0]
+        x, y, size = get_metatile(*req.key, self.metatile)
+        tiles = await self.inflight(
+            (self.layer, 'metatile', z, x, y, size),
+            self.render_metatile_and_write, z, x, y, size,
+        )
+        try:
+            return tiles[req.key]
+        except KeyError:
+            raise TileNotFound
+
+    async def __call__(self, req, encoding=None):
+        if 'Last-Modified' not in req.headers and req.stat is not None:
+            await self.modified(req)
+        if req.file is None:
+            content = await self.inflight(
+                (self.layer, req.key, None), self.source, *req.key
+            )
+            if encoding is not None:
+                content = await self.read(None, encoding, content)
+            return self.respond(req, content, encoding)
+        try:
+            body = await self.read(req.file, encoding)
+        except FileNotFoundError:
+            content = await self.render(req)
+            if self.dedupe:
+                req.headers['ETag'] = get_digest(content)
+            body = content
+            if encoding is not None:
+                body = await self.read(req.file, encoding, content)
         else:
-            async def lazypass():
-                try:
-                    content = await self.read()
-                    return content
-                except FileNotFoundError:
-                    content = await self.source(*self.key)
-                    await self.write(content)
-                    return content
-        return lazypass
-
-    async def __call__(self):
-        content = await self.lazypass()
-        return self.respond(content)
+            if self.dedupe and 'ETag' not in req.headers:
+                # stored meanwhile, or before dedupe was turned on
+                etag = await self.digest(req.file)
+                if etag is None and req.stat is not None:
+                    etag = get_etag_from_args(req.stat[0], *req.key)
+                if etag is not None:
+                    req.headers['ETag'] = etag
+        return self.respond(req, body, encoding)
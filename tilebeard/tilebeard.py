@@ -1,11 +1,18 @@
-import re
-from glob import iglob
+import time
+from email.utils import parsedate_to_datetime
 import asyncio
-from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 
-from .tile import FileTile, ProxyTile, LazyTile
-from .tilesource import ImageSource, VectorSource
-from .tbutils import TileNotFound
+from .tile import FileTile, ProxyTile, LazyTile, Coalescer, FileStore, Upstream, getmode
+from .tile import TileRequest
+from .tile import get_encodings, choose_encoding, encode_etag
+from .mbtiles import MBTiles
+from .diskcache import DiskCache
+from .tileindex import TileIndex
+from .tilesource import ImageSource, VectorSource, num2box, get_metatile
+from .tbutils import TileNotFound, UpstreamError, LRUCache, NegativeCache
+from .tbutils import get_digest
 
 NOT_FOUND = (
     404,
@@ -19,6 +26,74 @@ NOT_MODIFIED = (
     b'not modified',
 )
 
+CHECK_HEADERS = ('If-Modified-Since', 'If-None-Match')
+
+def is_not_modified(request_headers, checkvals, encoding=None):
+    '''
+    compares conditional request headers to (Last-Modified, ETag), the
+    ETag of the tile's representation in encoding if given
+    '''
+    lastmod, etag = checkvals
+    if encoding is not None and etag:
+        checkvals = lastmod, encode_etag(etag, encoding)
+    checks = [
+        request_headers[key] == val for key, val in zip(CHECK_HEADERS, checkvals)
+        if key in request_headers
+    ]
+    return checks != [] and all(checks)
+
+def is_conditional(request_headers):
+    return (
+        'If-None-Match' in request_headers or
+        'If-Modified-Since' in request_headers
+    )
+
+def get_checkvals(response):
+    headers = response[1]
+    return headers.get('Last-Modified'), headers.get('ETag')
+
+def first_true(n, test):
+    # smallest i in range(n) for which test, monotonic in i, is true
+    lo, hi = 0, n
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if test(mid):
+            hi = mid
+        else:
+            lo = mid + 1
+    return lo
+
+def tile_span(extent, z, srid='4326'):
+    '''
+    first and last column and row of the tiles at zoom z that intersect
+    extent, found by bisection instead of testing every requested tile
+    '''
+    n = 2**z
+    x0 = first_true(n, lambda x: num2box(z, x, 0, srid)[2] >= extent[0])
+    x1 = first_true(n, lambda x: num2box(z, x, 0, srid)[0] > extent[2]) - 1
+    y0 = first_true(n, lambda y: num2box(z, 0, y, srid)[1] <= extent[3])
+    y1 = first_true(n, lambda y: num2box(z, 0, y, srid)[3] < extent[1]) - 1
+    return x0, y0, x1, y1
+
+def get_expiry(headers):
+    try:
+        return parsedate_to_datetime(headers['Expires']).timestamp()
+    except (KeyError, TypeError, ValueError):
+        return None
+
+def sizeof_entry(entry):
+    # bodies are kept apart from entries, once per distinct content, so
+    # entries only take a rough allowance for the headers and bookkeeping
+    if isinstance(entry, (bytes, str)):
+        return len(entry)
+    return 512
+
+BAD_GATEWAY = (
+    502,
+    {'Content-Type': 'text/plain'},
+    b'bad gateway',
+)
+
 def get_tile_type(path, url, source): # graceful as a drunk bear...
     types = {
         (False, True, True): FileTile,
@@ -30,19 +105,147 @@ def get_tile_type(path, url, source): # graceful as a drunk bear...
     key = (not path, not url, not source)
     return types[key]
 
+def get_store(path, template, frmt, dedupe=False, disk_size=0):
+    if disk_size:
+        if path.endswith('.mbtiles') or dedupe:
+            raise ValueError('disk_size needs a tile directory without dedupe')
+        return DiskCache(path, template, getmode(frmt), disk_size)
+    if path.endswith('.mbtiles'):
+        return MBTiles(path, dedupe=dedupe, metadata={
+            'format': MBTILES_FORMATS.get(frmt, frmt),
+        })
+    return FileStore(path, template, getmode(frmt), dedupe)
+
+# format names the MBTiles spec uses, where they differ from ours
+MBTILES_FORMATS = {
+    'jpeg': 'jpg',
+    'mvt': 'pbf',
+}
+
 VECTOR_TYPES = (
     '.shp',
     '.geojson',
     '.json',
 )
 
+# tile formats VectorSource can write
+VECTOR_FORMATS = (
+    'geojson',
+    'json',
+    'mvt',
+    'pbf',
+)
+
 def get_source_constructor(source):
     for v in VECTOR_TYPES:
         if source.endswith(v):
             return VectorSource
     return ImageSource
 
-class TileBeard:
+def get_source(source, executor, frmt, source_kwargs):
+    '''
+    builds the builtin source for a file, vector sources writing tiles
+    in frmt if they can
+    '''
+    constructor = get_source_constructor(source)
+    kwargs = dict(source_kwargs)
+    if constructor is VectorSource and frmt in VECTOR_FORMATS:
+        kwargs.setdefault('frmt', frmt)
+    return constructor(source, executor, **kwargs)
+
+async def shutdown(executors):
+    # waits for the workers to exit without blocking the loop
+    loop = asyncio.get_event_loop()
+    while executors:
+        await loop.run_in_executor(None, executors.pop().shutdown)
+
+def batch_order(keys, metatile=1):
+    '''
+    distinct keys, grouped by layer and metatile so that siblings are
+    requested together
+    '''
+    def group(key):
+        z, x, y = (int(k) for k in key[-3:])
+        mx, my, size = get_metatile(z, x, y, metatile)
+        return tuple(str(k) for k in key[:-3]), z, my, mx, y, x
+    return sorted(set(tuple(key) for key in keys), key=group)
+
+class TileStream:
+    '''
+    Async iterator over (key, response) pairs of many tiles, yielded in
+    the order they are done, with at most concurrency of them in progress.
+    '''
+
+    def __init__(self, get, keys, concurrency=32):
+        self.get = get
+        self.keys = iter(keys)
+        self.concurrency = concurrency
+        self.pending = set()
+        self.done = deque()
+
+    def __aiter__(self):
+        return self
+
+    async def fetch(self, key):
+        return key, await self.get(key)
+
+    def fill(self):
+        for key in self.keys:
+            self.pending.add(asyncio.ensure_future(self.fetch(key)))
+            if len(self.pending) >= self.concurrency:
+                break
+
+    async def __anext__(self):
+        while not self.done:
+            self.fill()
+            if not self.pending:
+                raise StopAsyncIteration
+            done, self.pending = await asyncio.wait(
+                self.pending, return_when=asyncio.FIRST_COMPLETED
+            )
+            self.done.extend(done)
+        return self.done.popleft().result()
+
+    def cancel(self):
+        for future in self.pending:
+            future.cancel()
+        self.keys = iter(())
+
+async def collect(stream, keys):
+    responses = {}
+    try:
+        async for key, response in stream:
+            responses[key] = response
+    finally:
+        stream.cancel()
+    return [responses[tuple(key)] for key in keys]
+
+class ManyTiles:
+    '''
+    Batch requests for TileBeard and ClusterBeard, which are called with
+    (key, request_headers, filter) and have a metatile size.
+    '''
+
+    def iter_many(self, keys, request_headers={}, filter=None,
+        concurrency=32):
+        '''
+        returns an async iterator of (key, response) for keys (of any
+        layers, for ClusterBeard), yielding tiles as they are done
+        '''
+        async def get(key):
+            return await self(key, request_headers, filter)
+        return TileStream(get, batch_order(keys, self.metatile), concurrency)
+
+    async def get_many(self, keys, request_headers={}, filter=None,
+        concurrency=32):
+        '''
+        returns the responses for keys, in the same order
+        '''
+        return await collect(
+            self.iter_many(keys, request_headers, filter, concurrency), keys
+        )
+
+class TileBeard(ManyTiles):
     '''
     The adapter for serving a set of tiles.
     '''
@@ -50,7 +253,12 @@ class TileBeard:
     def __init__(self, path='', url='', source='',
         template='/{}/{}/{}', frmt='png', compresslevel=0,
         max_workers=5, executor=None, session=None, minzoom=0,
-        maxzoom=18, **source_kwargs):
+        maxzoom=18, processes=0, render_executor=None, inflight=None,
+        cache_size=0, cache_check=1, store=None, connections=8, timeout=10,
+        retries=2, backoff=.5, proxy_ttl=None, max_stale=None,
+        negative_ttl=0, negative_file=None, brotli=0, metatile=1,
+        tile_index=False, index_refresh=None, dedupe=False, disk_size=0,
+        **source_kwargs):
 
         if not path and not url and not source:
             raise ValueError('No path, url, or source object specified.')
@@ -60,86 +268,451 @@ class TileBeard:
         self.template = template
         self.format = frmt
         self.template += '.' + self.format
+        self.url_formatter = (
+            url.replace('{', '{{').replace('}', '}}') + self.template
+        ).format
         self.compresslevel = compresslevel
-        self.session = session
+        self.encodings = get_encodings(compresslevel, brotli)
+        self.accepted = {} # Accept-Encoding values seen, and their choices
+        if url:
+            self.upstream = Upstream(
+                session, connections, timeout, retries, backoff,
+                proxy_ttl, max_stale,
+            )
+        else:
+            self.upstream = None
         self.tile = get_tile_type(path, url, source)
+        if disk_size and self.tile is FileTile:
+            raise ValueError('disk_size only bounds tiles cached from a url or source')
+        self.metatile = metatile
+        self.tile_kwargs = {}
+        if self.tile is LazyTile:
+            self.tile_kwargs['metatile'] = metatile
+        if store is not None:
+            self.store = store
+        elif path:
+            self.store = get_store(
+                path, self.template, frmt, dedupe, disk_size
+            )
+        else:
+            self.store = None
         self.minzoom = minzoom
         self.maxzoom = maxzoom
         self.source_kwargs = source_kwargs
+        # in-flight renders and fetches, shared by concurrent misses
+        self.own_inflight = inflight is None
+        self.inflight = Coalescer() if inflight is None else inflight
+        # in-memory cache of final responses, bounded by cache_size bytes
+        if cache_size:
+            self.cache = LRUCache(
+                cache_size, sizeof=sizeof_entry, on_evict=self.cache_evicted
+            )
+        else:
+            self.cache = None
+        # counted per response, the cache's own counters see bodies too
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.cache_evictions = 0
+        self.cache_check = cache_check
+        self._source_mtime = None
+        self._source_checked = 0
+        # keys known to be empty, answered without any I/O
+        if negative_ttl:
+            self.negative = NegativeCache(negative_ttl, negative_file)
+        else:
+            self.negative = None
+        self.extent = None # source bounds, loaded on first request
+        self.spans = {} # tile ranges per zoom level covering the extent
+        # index of premade tiles, built on first request
+        self.use_index = tile_index and self.tile is FileTile
+        self.tile_index = None
+        self.index_refresh = index_refresh
+        self._index_built = 0
+        self.own_executors = [] # made here, shut down on close
         if executor is None:
             self.executor = ThreadPoolExecutor(max_workers=max_workers)
+            self.own_executors.append(self.executor)
         else:
             self.executor = executor
+        if render_executor is not None:
+            self.render_executor = render_executor
+        elif processes:
+            self.render_executor = ProcessPoolExecutor(max_workers=processes)
+            self.own_executors.append(self.render_executor)
+        else:
+            self.render_executor = self.executor
         if source:
-            if type(source) == str: # TODO: implement vector source support here
-                self.source = get_source_constructor(source)(source, self.executor, **self.source_kwargs)
+            if type(source) == str:
+                self.source = get_source(
+                    source, self.render_executor, frmt, self.source_kwargs
+                )
+                self.own_source = True
             else:
                 self.source = source
+                self.own_source = False
         else:
             self.source = None
-        if path is not None:
-            stars = '*' * template.count('{}')
-            globstring = path + template.format(*stars)
-            def count(self):
-                c = 0
-                for file in iglob(globstring):
-                    c += 1
-                return c
+            self.own_source = False
+        # one handler serves every tile of the layer
+        self.handler = self.tile(
+            self.format,
+            self.executor,
+            self.compresslevel,
+            self.upstream,
+            self.source,
+            inflight=self.inflight,
+            store=self.store,
+            encodings=self.encodings,
+            **self.tile_kwargs
+        )
+
+    async def close(self):
+        '''
+        cancels in-flight jobs, closes the upstream session, flushes
+        and closes the tile store and the source it opened, and shuts
+        down the executors it made
+        '''
+        if self.own_inflight: # shared ones belong to whoever passed them
+            for future in list(self.inflight.pending.values()):
+                future.cancel()
+        if self.upstream is not None:
+            await self.upstream.close()
+        if self.store is not None:
+            self.store.close()
+        loop = asyncio.get_event_loop()
+        if self.negative is not None:
+            await loop.run_in_executor(self.executor, self.negative.close)
+        close = getattr(self.source, 'close', None)
+        if self.own_source and close is not None:
+            await loop.run_in_executor(self.executor, close)
+            self.own_source = False # closed once
+        await shutdown(self.own_executors)
+
+    async def flush_negative(self):
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(self.executor, self.negative.flush)
+
+    def cache_stats(self):
+        '''
+        returns response and body counts, size and hit/miss/eviction
+        counters (per response) of the in-memory cache, or None if it is
+        disabled
+        '''
+        if self.cache is None:
+            return None
+        stats = self.cache.stats()
+        bodies = sum(1 for key, __ in self.cache.items() if key[0] == 'body')
+        return {
+            'entries': stats['entries'] - bodies,
+            'bodies': bodies,
+            'size': stats['size'],
+            'maxsize': stats['maxsize'],
+            'hits': self.cache_hits,
+            'misses': self.cache_misses,
+            'evictions': self.cache_evictions,
+        }
+
+    def cache_evicted(self, key, value):
+        if key[0] != 'body':
+            self.cache_evictions += 1
+
+    async def source_mtime(self):
+        '''
+        source modification time, checked at most every cache_check seconds
+        '''
+        now = time.monotonic()
+        if now - self._source_checked >= self.cache_check:
+            mtime = await self.source.modified()
+            if mtime != self._source_mtime:
+                self.extent = None
+                self.spans = {}
+                if self.negative is not None and self._source_mtime is not None:
+                    self.negative.clear()
+            self._source_mtime = mtime
+            self._source_checked = now
+        return self._source_mtime
+
+    async def refresh_index(self):
+        '''
+        rescans the tile store and swaps in the new tile index
+        '''
+        loop = asyncio.get_event_loop()
+        index = await loop.run_in_executor(
+            self.executor, TileIndex.scan, self.store
+        )
+        self.tile_index = index
+        self._index_built = time.monotonic()
+        return index
+
+    async def get_tile_index(self):
+        job = ('index', id(self))
+        if self.tile_index is None:
+            return await self.inflight(job, self.refresh_index)
+        if (
+            self.index_refresh is not None and
+            time.monotonic() - self._index_built >= self.index_refresh
+        ):
+            self.inflight(job, self.refresh_index) # swapped in when done
+        return self.tile_index
+
+    def count(self):
+        '''
+        number of tiles in the store, from the tile index if there is one
+        '''
+        if self.store is None:
+            return 0
+        return (self.tile_index or TileIndex.scan(self.store)).count()
+
+    def coverage(self):
+        '''
+        tile counts and column and row ranges per zoom level of the store
+        '''
+        if self.store is None:
+            return []
+        return (self.tile_index or TileIndex.scan(self.store)).coverage()
+
+    async def known_missing(self, key):
+        '''
+        rejects keys outside the zoom range or bounds of the source, not in
+        the tile index, or remembered as missing, before any executor work
+        '''
+        if self.use_index:
+            index = await self.get_tile_index()
+            if index.lookup(key) is None:
+                return True
+        if self.source is not None:
+            await self.source_mtime()
+            z, x, y = int(key[-3]), int(key[-2]), int(key[-1])
+            if not self.minzoom <= z <= self.maxzoom:
+                return True
+            if self.extent is None:
+                get_bounds = getattr(self.source, 'get_bounds', None)
+                if get_bounds is None:
+                    self.extent = False
+                else:
+                    loop = asyncio.get_event_loop()
+                    self.extent = await loop.run_in_executor(
+                        self.executor, get_bounds
+                    ) or False
+            if self.extent:
+                span = self.spans.get(z)
+                if span is None:
+                    span = self.spans[z] = tile_span(
+                        self.extent, z, getattr(self.source, 'srid', '4326')
+                    )
+                x0, y0, x1, y1 = span
+                if not (x0 <= x <= x1 and y0 <= y <= y1):
+                    return True
+        return self.negative is not None and key in self.negative
+
+    async def tile_mtime(self, key):
+        if self.tile_index is not None:
+            stat = self.tile_index.lookup(key)
+            if stat is None:
+                raise FileNotFoundError(key)
+            return stat[0]
+        if self.source is not None:
+            return await self.source_mtime()
+        if self.url:
+            return None # proxied tiles expire as the upstream says instead
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(
+            self.executor, self.store.modified, self.store.address(key)
+        )
+
+    def cache_get(self, key):
+        entry = self.cache.get(key)
+        if entry is None:
+            return None
+        status, headers, digest, mtime, checked = entry
+        body = self.cache.get(('body', digest))
+        if body is None:
+            self.cache.pop(key)
+            return None
+        return (status, headers, body), mtime, checked
+
+    def cache_put(self, key, response, mtime, checked=None):
+        '''
+        caches a response, its body stored once per distinct content
+        '''
+        status, headers, body = response
+        digest = get_digest(body)
+        self.cache.put(('body', digest), body)
+        if checked is None:
+            checked = time.monotonic()
+        self.cache.put(key, (status, headers, digest, mtime, checked))
+
+    async def cached(self, key):
+        '''
+        returns a still valid cached entry as (response, mtime), or None
+        '''
+        entry = self.cache_get(key)
+        if entry is None:
+            return None
+        response, mtime, checked = entry
+        if self.url:
+            if mtime is None or time.time() < mtime: # upstream expiry
+                return response, mtime
+            self.cache.pop(key)
+            return None
+        now = time.monotonic()
+        if self.source is None and now - checked < self.cache_check:
+            return response, mtime
+        try:
+            current = await self.tile_mtime(key[0])
+        except OSError:
+            current = None
+        if current != mtime:
+            self.cache.pop(key)
+            return None
+        if self.source is None:
+            self.cache_put(key, response, mtime, now)
+        return response, mtime
 
     async def __call__(self, key, request_headers={}, filter=None):
-        if self.path:
-            path = self.path + self.template.format(*key)
+        if await self.known_missing(key):
+            return NOT_FOUND
+        if self.cache is None:
+            return await self.respond(key, request_headers, filter)
+
+        key = tuple(key)
+        if filter is None:
+            encoding = self.get_encoding(request_headers)
         else:
-            path = None
-        if self.url:
-            url = self.url + self.template.format(*key)
+            encoding = None # filters work on the plain tile
+        # filtered tiles are cached too, if the filter has a signature
+        signature = getattr(filter, 'signature', None)
+        if signature is not None:
+            entry = await self.cached((key, signature))
+            if entry is not None:
+                self.cache_hits += 1
+                return self.conditional(request_headers, entry[0])
+
+        entry = await self.cached((key, encoding))
+        if entry is None:
+            self.cache_misses += 1
+            try:
+                mtime = await self.tile_mtime(key)
+            except OSError:
+                return NOT_FOUND
+            response = await self.respond(key, encoding=encoding, validate=True)
+            if response[0] != 200:
+                return response
+            if self.url:
+                mtime = get_expiry(response[1])
+            self.cache_put((key, encoding), response, mtime)
         else:
-            url = None
+            self.cache_hits += 1
+            response, mtime = entry
+
+        if filter is None:
+            return self.conditional(request_headers, response)
+        if self.conditional(request_headers, response) is NOT_MODIFIED:
+            return NOT_MODIFIED
+        response = await self.apply_filter(response, filter)
+        if signature is not None:
+            self.cache_put((key, signature), response, mtime)
+        return response
 
+    def conditional(self, request_headers, response):
+        if (
+            is_conditional(request_headers) and
+            is_not_modified(request_headers, get_checkvals(response))
+        ):
+            return NOT_MODIFIED
+        return response
+
+    def get_encoding(self, request_headers):
+        '''
+        content encoding for the request, chosen once per distinct
+        Accept-Encoding value
+        '''
+        if not self.encodings:
+            return None
+        accept = request_headers.get('Accept-Encoding')
         try:
-            tile = self.tile(
-                path,
-                self.format,
-                self.executor,
-                self.compresslevel,
-                url,
-                self.session,
-                self.source,
-                key,
-            )
+            return self.accepted[accept]
+        except KeyError:
+            pass
+        if len(self.accepted) >= 256: # clients send few distinct values
+            self.accepted.clear()
+        encoding = choose_encoding(accept, self.encodings)
+        self.accepted[accept] = encoding
+        return encoding
 
-            check_headers = [
-                key for key in ('If-Modified-Since', 'If-None-Match') if key in request_headers
-            ]
+    async def apply_filter(self, response, filter):
+        loop = asyncio.get_event_loop()
+        content = await loop.run_in_executor(
+            self.executor, filter, response[-1]
+        )
+        status, headers, body = response
+        if 'Content-Length' in headers:
+            headers = {**headers, 'Content-Length': len(content)}
+        return status, headers, content
+
+    def tile_stat(self, key):
+        '''
+        (mtime, size) of the tile at key if it is known without I/O, from
+        the tile index or, for generated tiles, the source
+        '''
+        if self.tile_index is not None:
+            return self.tile_index.lookup(key)
+        if self.source is not None and self._source_mtime is not None:
+            return self._source_mtime, None
+        return None
 
-            if check_headers != []:
-                checkvals = await tile.modified() # NOTE: make this support ProxyTile
-                checks = [
-                    request_headers[key] == checkvals[i] for i, key in enumerate(check_headers)
-                ]
-                if sum(checks) == len(checks):
+    async def respond(self, key, request_headers={}, filter=None,
+        encoding=None, validate=False):
+        if self.source is not None:
+            key = tuple(int(k) for k in key)
+        req = TileRequest(
+            key,
+            self.store.address(key) if self.store is not None else None,
+            self.url_formatter(*key) if self.url else None,
+            self.tile_stat(key),
+        )
+
+        if filter is None and encoding is None:
+            encoding = self.get_encoding(request_headers)
+        try:
+            if is_conditional(request_headers):
+                checkvals = await self.handler.modified(req)
+                if is_not_modified(request_headers, checkvals, encoding):
                     return NOT_MODIFIED
+            elif validate:
+                await self.handler.modified(req) # validators for the cache
 
-            response = await tile()
+            response = await self.handler(req, encoding)
 
             if filter is not None:
-                response = (*response[:2], filter(response[-1]))
+                response = await self.apply_filter(response, filter)
 
             return response
 
-        except TileNotFound:
+        except (TileNotFound, FileNotFoundError):
+            if self.negative is not None:
+                self.negative.add(key)
+                if self.negative.due():
+                    self.inflight(('negative', id(self)), self.flush_negative)
             return NOT_FOUND
+        except UpstreamError:
+            return BAD_GATEWAY
 
-class ClusterBeard:
+class ClusterBeard(ManyTiles):
     '''
     Adapter for serving multiple layers (TileBeards).
-    Meant only for on-demand tiles (and .mbtiles in the future), since
+    Meant only for on-demand tiles (cached as files or in one .mbtiles
+    file per layer), since
     TileBeard can already handle this on its own for premade pyramids and
     proxy urls by passing custom template arguments.
+    Child TileBeards (with their sources and stores) are kept for up to
+    max_layers recently used layers and closed when evicted.
     '''
 
     def __init__(self, source, frmt='png', tilepath='', compresslevel=0,
-        max_workers=5, executor=None, minzoom=0, maxzoom=18, **source_kwargs):
+        max_workers=5, executor=None, minzoom=0, maxzoom=18, processes=0,
+        render_executor=None, brotli=0, metatile=1, max_layers=64,
+        dedupe=False, disk_size=0, **source_kwargs):
 
         self.minzoom = minzoom
         self.maxzoom = maxzoom
@@ -152,34 +725,103 @@ class ClusterBeard:
             except AttributeError:
                 count = source.argnum
 
-            self.tilepath = tilepath + '/{}' * count
+            if tilepath.endswith('.mbtiles'):
+                if tilepath.count('{}') != count:
+                    raise ValueError(
+                        'an .mbtiles tilepath needs one {{}} per layer '
+                        'argument ({})'.format(count)
+                    )
+                self.tilepath = tilepath # one .mbtiles file per layer
+            else:
+                self.tilepath = tilepath + '/{}' * count
         else:
             self.tilepath = sourcepath + '/tiles'
         self.compresslevel = compresslevel
+        self.brotli = brotli
+        self.metatile = metatile
+        self.dedupe = dedupe
+        self.disk_size = disk_size
+        self.inflight = Coalescer()
+        self.beards = LRUCache(
+            max_layers, sizeof=lambda beard: 1, on_evict=self.evict
+        )
+        self.active = {} # requests in progress per child
+        self.evicted = set()
+        self.own_executors = [] # made here, shut down on close
         if executor is None:
             self.executor = ThreadPoolExecutor(max_workers=max_workers)
+            self.own_executors.append(self.executor)
         else:
             self.executor = executor
+        if render_executor is not None:
+            self.render_executor = render_executor
+        elif processes:
+            self.render_executor = ProcessPoolExecutor(max_workers=processes)
+            self.own_executors.append(self.render_executor)
+        else:
+            self.render_executor = self.executor
 
-    async def __call__(self, key, request_headers={}, filter=None):
-        if not self.minzoom <= int(key[-3]) <= self.maxzoom:
-            return NOT_FOUND
+    def evict(self, layer, beard):
+        # children still serving requests are closed when they are done
+        if self.active.get(beard):
+            self.evicted.add(beard)
+        else:
+            asyncio.ensure_future(beard.close())
+
+    async def close(self):
+        for future in list(self.inflight.pending.values()):
+            future.cancel()
+        beards = [beard for layer, beard in self.beards.items()]
+        beards.extend(self.evicted)
+        self.beards.clear()
+        self.evicted.clear()
+        for beard in beards:
+            await beard.close()
+        await shutdown(self.own_executors)
+
+    def get_beard(self, layer):
+        beard = self.beards.get(layer)
+        if beard is not None:
+            return beard
         if type(self.source) == str:
-            source = self.source.format(*key[:-3])
+            source = self.source.format(*layer)
         else:
-            source = self.source(*key[:-3], **self.source_kwargs)
+            source = self.source(*layer, **self.source_kwargs)
         beard = TileBeard(
             source = source,
-            path = self.tilepath.format(*key[:-3]),
+            path = self.tilepath.format(*layer),
             frmt = self.format,
             compresslevel = self.compresslevel,
+            brotli = self.brotli,
+            metatile = self.metatile,
+            dedupe = self.dedupe,
+            disk_size = self.disk_size,
             executor = self.executor, # joint executor for all childbeards
+            render_executor = self.render_executor,
+            inflight = self.inflight,
             minzoom = self.minzoom,
             maxzoom = self.maxzoom,
             **self.source_kwargs
         )
-        return await beard(
-            key[-3:],
-            request_headers=request_headers,
-            filter=filter
-        )
+        beard.own_source = True # built here, closed with the child
+        self.beards.put(layer, beard)
+        return beard
+
+    async def __call__(self, key, request_headers={}, filter=None):
+        if not self.minzoom <= int(key[-3]) <= self.maxzoom:
+            return NOT_FOUND
+        beard = self.get_beard(tuple(key[:-3]))
+        self.active[beard] = self.active.get(beard, 0) + 1
+        try:
+            return await beard(
+                key[-3:],
+                request_headers=request_headers,
+                filter=filter
+            )
+        finally:
+            self.active[beard] -= 1
+            if not self.active[beard]:
+                del self.active[beard]
+                if beard in self.evicted:
+                    self.evicted.discard(beard)
+                    await beard.close()
@@ -0,0 +1,73 @@
+import numpy as np
+
+class TileIndex:
+    '''
+    In-memory index of the tiles present in a store, with their
+    modification times and sizes. Tiles are grouped by layer (the key
+    members before z, x, y) and zoom level, each group being a sorted
+    array of packed (x, y) codes, so lookups are binary searches without
+    any I/O. Built from the store's scan(), which yields (key, mtime, size).
+    '''
+
+    def __init__(self, entries):
+        groups = {}
+        for key, mtime, size in entries:
+            try:
+                z, x, y = (int(k) for k in key[-3:])
+            except ValueError:
+                continue
+            group = groups.setdefault((tuple(key[:-3]), z), ([], [], []))
+            group[0].append(x << 32 | y)
+            group[1].append(mtime)
+            group[2].append(size)
+        self.levels = {}
+        for level, (codes, mtimes, sizes) in groups.items():
+            codes = np.array(codes, dtype=np.int64)
+            order = np.argsort(codes)
+            self.levels[level] = (
+                codes[order],
+                np.array(mtimes, dtype=np.float64)[order],
+                np.array(sizes, dtype=np.int64)[order],
+            )
+
+    @classmethod
+    def scan(cls, store):
+        return cls(store.scan())
+
+    def lookup(self, key):
+        '''
+        returns (mtime, size) of the tile at key, None if it is missing
+        '''
+        z, x, y = (int(k) for k in key[-3:])
+        try:
+            codes, mtimes, sizes = self.levels[(tuple(str(k) for k in key[:-3]), z)]
+        except KeyError:
+            return None
+        code = x << 32 | y
+        i = int(np.searchsorted(codes, code))
+        if i == len(codes) or codes[i] != code:
+            return None
+        return float(mtimes[i]), int(sizes[i])
+
+    def __contains__(self, key):
+        return self.lookup(key) is not None
+
+    def count(self):
+        return sum(len(codes) for codes, mtimes, sizes in self.levels.values())
+
+    def coverage(self):
+        '''
+        returns tile count and column and row ranges per layer and zoom
+        '''
+        coverage = []
+        for (layer, z), (codes, mtimes, sizes) in sorted(self.levels.items()):
+            xs, ys = codes >> 32, codes & 0xffffffff
+            coverage.append({
+                'layer': layer,
+                'zoom': z,
+                'tiles': len(codes),
+                'columns': (int(xs.min()), int(xs.max())),
+                'rows': (int(ys.min()), int(ys.max())),
+                'size': int(sizes.sum()),
+            })
+        return coverage
@@ -3,15 +3,20 @@ from PIL import Image
 import asyncio
 from io import BytesIO
 import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
 import mercantile
 import fiona
 from shapely import speedups
 if speedups.available:
     speedups.enable()
 from shapely import geometry as shp
+from shapely.strtree import STRtree
 import ujson
 
-from .tbutils import ObjDict, TileNotFound
+from .tbutils import ObjDict, TileNotFound, LRUCache
+from .raster import RasterReader, Overviews, scale
+from . import mvt
 
 def num2box(z, x, y, srid='4326'):
     if srid == '4326':
@@ -37,7 +42,7 @@ def get_world_data(imagefile, imagesize):
     # TODO: implement support for skewed images...
     worldfile = imagefile[:-2]+imagefile[-1]+'w'
     with open(worldfile, 'r') as f:
-        data = [float(x) for x in f.read().split('\n')]
+        data = [float(x) for x in f.read().split()]
     xres = data[0]
     yres = -data[3]
     w = xres * imagesize[0]
@@ -72,70 +77,231 @@ def bufferize(box, buffer):
         box[3] + ybuffer,
     )
 
-def crop(imagefile, box):
+def crop(raster, box, tilesize=None):
     '''
-    faster crop for uncompressed images
+    reads the part of an opened raster covered by box, from the coarsest
+    overview level that still fills tilesize if the raster has overviews
     '''
-    with Image.open(imagefile) as image:
+    check_if_intersect(box, raster.world)
+    bounds = box2pix(box, raster.world)
+    if tilesize is not None and raster.overviews is not None:
+        level, bounds = raster.overviews.select(bounds, tilesize)
+        return level.read(bounds)
+    return raster.read(bounds)
 
-        world = get_world_data(imagefile, image.size)
-        check_if_intersect(box, world)
-        bounds = box2pix(box, world)
+def get_metatile(z, x, y, size):
+    '''
+    returns the first column and row and the size of the metatile
+    containing tile (z, x, y)
+    '''
+    size = max(min(size, 2**z), 1)
+    return x - x % size, y - y % size, size
 
-        if image.tile[0][0] == 'raw':
-
-            iw, ih = image.size
-            offset = image.tile[0][2]
-
-            x = bounds[0]
-            y = bounds[1]
-            x1 = bounds[2]
-            y1 = bounds[3]
-            w = x1 - x
-            h = y1 - y
-            hcorr = min(h, ih-abs(y))
-
-            image.size = (iw, hcorr)
-            image.tile = [
-                (
-                    'raw',
-                    (0, 0, iw, hcorr),
-                    offset + 4 * iw * max(0, y),
-                    ('RGBA', 0, 1),
-                )
-            ]
-            return image.crop((x, min(0, y), x+w, min(h, y1)))
+def metatile_box(z, x, y, size, srid='4326'):
+    first = num2box(z, x, y, srid)
+    last = num2box(z, x + size - 1, y + size - 1, srid)
+    return first[0], last[1], last[2], first[3]
+
+def from_spec(spec):
+    cls, file, kwargs = spec
+    return cls(file, None, **dict(kwargs))
 
-        return image.crop(bounds)
+# sources kept open by each worker process between jobs, keyed by spec
+_worker_sources = LRUCache(
+    64, sizeof=lambda source: 1, on_evict=lambda spec, source: source.close()
+)
 
-class ImageSource:
+def worker_source(spec):
+    source = _worker_sources.get(spec)
+    if source is None:
+        source = from_spec(spec)
+        _worker_sources.put(spec, source)
+    return source
+
+def render_tile(spec, z, x, y):
+    '''
+    renders a tile in a worker process, reusing a warm source if the
+    worker has rendered from the same spec before
+    '''
+    return worker_source(spec).render(z, x, y)
+
+def render_metatile(spec, z, x, y, size):
+    return worker_source(spec).render_metatile(z, x, y, size)
+
+class TileSource:
+    '''
+    Base class for builtin sources. A source is described by its spec
+    (class, file and keyword arguments), which is what gets pickled, so
+    sources can be sent to and rebuilt in worker processes. When the
+    executor is a ProcessPoolExecutor, tiles are rendered and encoded in
+    the workers and come back as bytes.
+    '''
+
+    def __init__(self, file, executor, **kwargs):
+        self.file = file
+        self.executor = executor
+        self.spec = (type(self), file, tuple(sorted(kwargs.items())))
+
+    def __reduce__(self):
+        return from_spec, (self.spec,)
+
+    async def modified(self):
+        return os.path.getmtime(self.file)
+
+    def close(self):
+        '''
+        releases open files and in-memory state, which are rebuilt on the
+        next render
+        '''
+        pass
+
+    def render(self, z, x, y):
+        raise NotImplementedError
+
+    def render_metatile(self, z, x, y, size):
+        '''
+        renders the size x size block of tiles whose top left tile is
+        (z, x, y) as {(z, x, y): content}, leaving out empty tiles
+        '''
+        tiles = {}
+        for ty in range(y, y + size):
+            for tx in range(x, x + size):
+                try:
+                    tiles[(z, tx, ty)] = self.render(z, tx, ty)
+                except TileNotFound:
+                    pass
+        return tiles
+
+    async def dispatch(self, task, method, *args):
+        loop = asyncio.get_event_loop()
+        if isinstance(self.executor, ProcessPoolExecutor):
+            return await loop.run_in_executor(
+                self.executor, task, self.spec, *args
+            )
+        return await loop.run_in_executor(self.executor, method, *args)
+
+    async def metatile(self, z, x, y, size):
+        return await self.dispatch(
+            render_metatile, self.render_metatile, z, x, y, size
+        )
+
+    async def __call__(self, z, x, y):
+        return await self.dispatch(render_tile, self.render, z, x, y)
+
+class ImageSource(TileSource):
     '''
     Class for generating tiles on demand from image source.
+    The image and its world file are opened once and reopened only
+    when the image changes. With overviews=True, low zoom tiles are read
+    from a lazily built pyramid of decimated levels instead of being
+    resampled from the full resolution image.
     '''
 
     def __init__(self, imagefile, executor, srid='4326',
-        frmt='PNG', tilesize=(256, 256), resample=Image.BILINEAR):
+        frmt='PNG', tilesize=(256, 256), resample=Image.BILINEAR,
+        blockcache=64 * 2**20, overviews=False, overview_dir=None):
+        super(ImageSource, self).__init__(
+            imagefile, executor, srid=srid, frmt=frmt, tilesize=tilesize,
+            resample=resample, blockcache=blockcache, overviews=overviews,
+            overview_dir=overview_dir,
+        )
         self.tilesize = tilesize
         self.resample = resample
-        self.file = imagefile
-        self.executor = executor
         self.format = frmt
         self.srid = srid
+        self.blockcache = blockcache
+        self.overviews = overviews
+        self.overview_dir = overview_dir
+        self._raster = None
+        self._lock = threading.Lock()
 
-    async def modified(self):
-        return os.path.getmtime(self.file)
+    def get_raster(self):
+        mtime = os.path.getmtime(self.file)
+        raster = self._raster
+        if raster is None or raster.mtime != mtime:
+            with self._lock:
+                raster = self._raster
+                if raster is None or raster.mtime != mtime:
+                    raster = RasterReader(self.file, self.blockcache)
+                    raster.world = get_world_data(self.file, raster.size)
+                    raster.overviews = None
+                    if self.overviews:
+                        raster.overviews = Overviews(
+                            raster, self.tilesize, self.overview_dir
+                        )
+                    self._raster = raster
+        return raster
+
+    def close(self):
+        with self._lock:
+            raster, self._raster = self._raster, None
+        if raster is not None:
+            if raster.overviews is not None:
+                raster.overviews.close()
+            raster.close()
+
+    def get_bounds(self):
+        world = self.get_raster().world
+        return world.W, world.S, world.E, world.N
 
     def get_tile(self, box):
-        return crop(self.file, box).resize(self.tilesize, self.resample)
+        return crop(self.get_raster(), box, self.tilesize).resize(
+            self.tilesize, self.resample
+        )
 
-    async def __call__(self, z, x, y):
-        loop = asyncio.get_event_loop()
+    def encode(self, image):
         response = BytesIO()
-        box = list(num2box(z, x, y, self.srid))
-        tile = await loop.run_in_executor(self.executor, self.get_tile, box)
-        tile.save(response, format=self.format)
+        image.save(response, format=self.format)
         return response.getvalue()
 
+    def render(self, z, x, y):
+        '''
+        renders and encodes a tile, meant to run in the executor
+        '''
+        box = list(num2box(z, x, y, self.srid))
+        return self.encode(self.get_tile(box))
+
+    def render_metatile(self, z, x, y, size):
+        '''
+        reads the window under the whole metatile once and cuts it into
+        tiles; tile bounds are computed in pixel space one by one, so rows
+        stay aligned for sources in 4326
+        '''
+        raster = self.get_raster()
+        world = raster.world
+        box = metatile_box(z, x, y, size, self.srid)
+        try:
+            check_if_intersect(box, world)
+        except TileNotFound:
+            return {}
+        bounds = box2pix(box, world)
+        level, factor = raster, 1
+        if raster.overviews is not None:
+            factor = raster.overviews.factor(bounds, (
+                self.tilesize[0] * size, self.tilesize[1] * size
+            ))
+            level = raster.overviews.get_level(factor)
+        origin = scale(bounds, factor)
+        window = level.read(origin)
+        tiles = {}
+        for ty in range(y, y + size):
+            for tx in range(x, x + size):
+                tilebox = num2box(z, tx, ty, self.srid)
+                try:
+                    check_if_intersect(tilebox, world)
+                except TileNotFound:
+                    continue
+                left, upper, right, lower = scale(box2pix(tilebox, world), factor)
+                tile = window.crop((
+                    left - origin[0], upper - origin[1],
+                    max(right, left + 1) - origin[0],
+                    max(lower, upper + 1) - origin[1],
+                ))
+                tiles[(z, tx, ty)] = self.encode(
+                    tile.resize(self.tilesize, self.resample)
+                )
+        return tiles
+
 def get_simplify_tolerance(box, relative_tolerance):
     '''
     returns distance passed to shapely.geometry.simplify
@@ -145,47 +311,259 @@ def get_simplify_tolerance(box, relative_tolerance):
     )
     return diagonal * relative_tolerance
 
-class VectorSource:
+class FeatureIndex:
+    '''
+    In-memory STR-tree over the features of a vector file, built once
+    per file modification.
+    '''
+
+    def __init__(self, vectorfile):
+        self.mtime = os.path.getmtime(vectorfile)
+        self.geometries = []
+        self.features = []
+        with fiona.open(vectorfile, 'r') as cake:
+            for feat in cake:
+                if feat['geometry'] is None:
+                    continue
+                self.geometries.append(shp.shape(feat['geometry']))
+                self.features.append({
+                    'type': 'Feature',
+                    'id': feat['id'],
+                    'properties': dict(feat['properties']),
+                })
+        self.bounds = [geom.bounds for geom in self.geometries]
+        self.extent = (
+            min(b[0] for b in self.bounds), min(b[1] for b in self.bounds),
+            max(b[2] for b in self.bounds), max(b[3] for b in self.bounds),
+        ) if self.bounds else None
+        self.tree = STRtree(self.geometries)
+        # shapely<2 returns geometries from queries instead of indices
+        self.ids = {id(geom): i for i, geom in enumerate(self.geometries)}
+        self.levels = {}
+        self.lock = threading.Lock()
+
+    def level(self, zoom, tolerance, preserve_topology=True):
+        '''
+        returns the geometries simplified for tiles at zoom, built on
+        first use; simplified geometries stay within the original bounds,
+        so the tree and bounds of the originals still apply to them
+        '''
+        try:
+            return self.levels[zoom]
+        except KeyError:
+            pass
+        with self.lock:
+            if zoom not in self.levels:
+                self.levels[zoom] = [
+                    geom.simplify(tolerance, preserve_topology)
+                    for geom in self.geometries
+                ]
+            return self.levels[zoom]
+
+    def query(self, geobox):
+        '''
+        returns indices of features whose envelopes hit geobox
+        '''
+        hits = self.tree.query(geobox)
+        if len(hits) and hasattr(hits[0], 'geom_type'):
+            return sorted(self.ids[id(geom)] for geom in hits)
+        return sorted(int(i) for i in hits)
+
+def intersects(a, b):
+    return not (a[0] > b[2] or a[1] > b[3] or a[2] < b[0] or a[3] < b[1])
+
+MVT_FORMATS = ('mvt', 'pbf')
+
+def feature_collection(features):
+    return {
+        'type': 'FeatureCollection',
+        'features': [
+            dict(feature, geometry=shp.mapping(geom))
+            for geom, feature in features
+        ],
+    }
+
+def box_contains(box, bounds):
+    return (
+        box[0] <= bounds[0] and box[1] <= bounds[1] and
+        box[2] >= bounds[2] and box[3] >= bounds[3]
+    )
+
+class VectorSource(TileSource):
     '''
     Class for generating tiles on demand from vector source.
+    With index=True, features are loaded once and queried through an
+    in-memory spatial index that is rebuilt when the file changes.
+    Tiles are GeoJSON, or Mapbox Vector Tiles with frmt 'mvt' or 'pbf';
+    quantize=True writes GeoJSON in the integer tile coordinates of MVT.
+    With generalize=N, features are simplified once per zoom level up to
+    N (implying index=True) instead of once per tile.
     '''
 
     def __init__(self, vectorfile, executor,
         srid='4326', buffer=0, relative_tolerance=.0005,
-        preserve_topology=True):
-        self.format = 'geojson'
-        self.file = vectorfile
-        self.executor = executor
+        preserve_topology=True, index=False, frmt='geojson', layer=None,
+        extent=4096, quantize=False, generalize=None):
+        super(VectorSource, self).__init__(
+            vectorfile, executor, srid=srid, buffer=buffer,
+            relative_tolerance=relative_tolerance,
+            preserve_topology=preserve_topology, index=index, frmt=frmt,
+            layer=layer, extent=extent, quantize=quantize,
+            generalize=generalize,
+        )
+        self.format = frmt
+        if layer is None:
+            layer = os.path.splitext(os.path.basename(vectorfile))[0]
+        self.layer = layer
+        self.extent = extent
+        self.quantize = quantize
         self.srid = srid
         self.buffer = buffer
         self.relative_tolerance = relative_tolerance
         self.preserve_topology = preserve_topology
+        self.generalize = generalize
+        self.index = index or generalize is not None
+        self._index = None
+        self._lock = threading.Lock()
 
-    async def modified(self):
-        return os.path.getmtime(self.file)
+    def get_index(self):
+        mtime = os.path.getmtime(self.file)
+        index = self._index
+        if index is None or index.mtime != mtime:
+            with self._lock:
+                index = self._index
+                if index is None or index.mtime != mtime:
+                    index = self._index = FeatureIndex(self.file)
+        return index
 
-    def get_tile(self, box):
-        features = []
-        geobox = shp.box(
-            *bufferize(box, self.buffer)
+    def close(self):
+        self._index = None
+
+    def get_bounds(self):
+        if self.index:
+            return self.get_index().extent
+        with fiona.open(self.file, 'r') as cake:
+            return cake.bounds
+
+    def generalized(self, z):
+        return self.generalize is not None and z is not None and z <= self.generalize
+
+    def get_level(self, index, z):
+        # tiles of a zoom level share one width, which sets the tolerance
+        box = num2box(z, 0, 0, self.srid)
+        width = box[2] - box[0]
+        return index.level(
+            z,
+            get_simplify_tolerance((0, 0, width, width), self.relative_tolerance),
+            self.preserve_topology,
         )
-        tolerance = get_simplify_tolerance(box, self.relative_tolerance)
+
+    def get_candidates(self, box, z=None):
+        '''
+        returns (geometry, bounds, feature) of every feature whose
+        envelope hits box, from the index or from one scan of the file;
+        geometries come pre-generalized for zoom z if it has a level
+        '''
+        geobox = shp.box(*box)
+        if self.index:
+            index = self.get_index()
+            geometries = index.geometries
+            if self.generalized(z):
+                geometries = self.get_level(index, z)
+            return [
+                (geometries[i], index.bounds[i], index.features[i])
+                for i in index.query(geobox)
+            ]
+        candidates = []
         with fiona.open(self.file, 'r') as cake:
             for feat in cake:
-                cut = shp.shape(feat['geometry']).intersection(geobox)
-                if cut.is_empty:
+                if feat['geometry'] is None:
                     continue
-                feat['geometry'] = shp.mapping(
-                    cut.simplify(tolerance, self.preserve_topology)
-                )
-                features.append(feat)
-        return {
-            'type': 'FeatureCollection',
-            'features': features,
-        }
+                geom = shp.shape(feat['geometry'])
+                bounds = geom.bounds
+                if intersects(bounds, box):
+                    candidates.append((geom, bounds, {
+                        'type': 'Feature',
+                        'id': feat['id'],
+                        'properties': dict(feat['properties']),
+                    }))
+        return candidates
 
-    async def __call__(self, z, x, y):
-        loop = asyncio.get_event_loop()
+    def clip(self, candidates, box, simplify=True):
+        '''
+        cuts candidates to the buffered box and simplifies them for the
+        tile covering box (unless they already are), returns (geometry,
+        feature) pairs
+        '''
+        features = []
+        buffered = bufferize(box, self.buffer)
+        geobox = shp.box(*buffered)
+        tolerance = get_simplify_tolerance(box, self.relative_tolerance)
+        for geom, bounds, feature in candidates:
+            if box_contains(buffered, bounds):
+                cut = geom
+            elif not intersects(bounds, buffered):
+                continue
+            else:
+                cut = geom.intersection(geobox)
+            if simplify:
+                cut = cut.simplify(tolerance, self.preserve_topology)
+            if cut.is_empty:
+                continue
+            features.append((cut, feature))
+        return features
+
+    def get_features(self, box, z=None):
+        return self.clip(
+            self.get_candidates(bufferize(box, self.buffer), z), box,
+            not self.generalized(z),
+        )
+
+    def get_tile(self, box):
+        return feature_collection(self.get_features(box))
+
+    def serialize(self, features, box):
+        if self.format in MVT_FORMATS:
+            return mvt.encode(features, box, self.srid, self.layer, self.extent)
+        if self.quantize:
+            grid = mvt.Grid(box, self.srid, self.extent)
+            collection = []
+            for geom, feature in features:
+                geometry = mvt.to_geojson(geom, grid)
+                if geometry is not None:
+                    feat = dict(feature)
+                    feat['geometry'] = geometry
+                    collection.append(feat)
+            return ujson.dumps({
+                'type': 'FeatureCollection',
+                'extent': self.extent,
+                'features': collection,
+            })
+        return ujson.dumps(feature_collection(features))
+
+    def render(self, z, x, y):
+        '''
+        renders and serializes a tile, meant to run in the executor
+        '''
         box = num2box(z, x, y, self.srid)
-        tile = await loop.run_in_executor(self.executor, self.get_tile, box)
-        return ujson.dumps(tile)
+        return self.serialize(self.get_features(box, z), box)
+
+    def render_metatile(self, z, x, y, size):
+        '''
+        queries features under the whole (buffered) metatile once and
+        clips them for each tile
+        '''
+        boxes = {
+            (z, tx, ty): num2box(z, tx, ty, self.srid)
+            for ty in range(y, y + size) for tx in range(x, x + size)
+        }
+        buffered = [bufferize(box, self.buffer) for box in boxes.values()]
+        candidates = self.get_candidates((
+            min(b[0] for b in buffered), min(b[1] for b in buffered),
+            max(b[2] for b in buffered), max(b[3] for b in buffered),
+        ), z)
+        simplify = not self.generalized(z)
+        return {
+            key: self.serialize(self.clip(candidates, box, simplify), box)
+            for key, box in boxes.items()
+        }